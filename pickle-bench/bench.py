@@ -0,0 +1,920 @@
+"""Offline load-test benchmark for the three Pickle Lambdas.
+
+Imports the real lambda_handlers and points them at local stand-ins with
+configurable latency, error-rate and throttling profiles: a fake Bedrock
+client, a fake NewsAPI HTTP server, in-memory DynamoDB tables and a fake
+SES. A synthetic subscriber population is registered through
+pickle-user-insertion, digests are generated by pickle-user-prompt and
+delivered by pickle-email, and per-stage wall time, calls per user and
+peak memory are reported.
+
+Usage:
+    python pickle-bench/bench.py --users 100 1000 10000
+    python pickle-bench/bench.py --users 1000 --profile realistic --latency-scale 0.01
+    python pickle-bench/bench.py --users 1000 --execution-mode pipelined --json results.json
+    python pickle-bench/bench.py --users 1000 --news-ceiling 20 --news-max-rate 50
+"""
+
+import argparse
+import bisect
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import zlib
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Shared modules the Lambdas load from the pickle-layer Lambda layer
+sys.path.insert(0, os.path.join(REPO_ROOT, 'pickle-layer', 'python'))
+
+# Latency (ms), error and throttling profiles for the fake services
+PROFILES = {
+    'instant': {
+        'bedrock_ms': 0, 'news_ms': 0, 'dynamodb_ms': 0, 'ses_ms': 0,
+        'error_rate': 0.0, 'throttle_rate': 0.0
+    },
+    'realistic': {
+        'bedrock_ms': 1500, 'news_ms': 300, 'dynamodb_ms': 8, 'ses_ms': 60,
+        'error_rate': 0.0, 'throttle_rate': 0.0
+    },
+    'flaky': {
+        'bedrock_ms': 1500, 'news_ms': 300, 'dynamodb_ms': 8, 'ses_ms': 60,
+        'error_rate': 0.02, 'throttle_rate': 0.0
+    },
+    'throttled': {
+        'bedrock_ms': 1500, 'news_ms': 300, 'dynamodb_ms': 8, 'ses_ms': 60,
+        'error_rate': 0.0, 'throttle_rate': 0.1
+    }
+}
+
+# Functions timed as stages in each Lambda module
+STAGES = {
+    'pickle-user-insertion': ['create_subscription'],
+    'pickle-user-prompt': [
+        'iter_active_subscriptions', 'cluster_topics', 'generate_keywords_batch',
+        'generate_keywords_with_llm', 'fetch_news_articles', 'call_news_api_everything',
+        'rank_articles_by_relevance', 'rank_articles_bm25', 'generate_digest_content', 'store_digest'
+    ],
+    'pickle-email': ['deliver_digests', 'send_email']
+}
+
+BASE_TOPICS = [
+    'artificial intelligence', 'AI', 'climate change', 'electric vehicles', 'EV news',
+    'space exploration', 'cryptocurrency', 'stock market', 'Formula 1', 'Premier League',
+    'quantum computing', 'cybersecurity', 'renewable energy', 'biotech', 'housing market',
+    'video games', 'semiconductors', 'OpenAI', 'Tesla', 'NBA'
+]
+
+SHARED_VOCAB = [
+    'Tesla', 'OpenAI', 'NASA', 'Bitcoin', 'Nvidia', 'Apple', 'climate', 'battery',
+    'election', 'Federal Reserve', 'SpaceX', 'Google', 'Microsoft', 'inflation'
+]
+
+class ServiceProfile:
+    """Latency, error and throttling behaviour shared by the fakes"""
+
+    def __init__(self, bedrock_ms, news_ms, dynamodb_ms, ses_ms, error_rate, throttle_rate, seed=0, ceilings=None):
+        self.latency = {
+            'bedrock': bedrock_ms / 1000,
+            'news': news_ms / 1000,
+            'dynamodb': dynamodb_ms / 1000,
+            'ses': ses_ms / 1000
+        }
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.calls = {service: 0 for service in self.latency}
+        # Provider-side request ceilings (per second, one second of burst); calls above are throttled
+        self.ceilings = {service: rate for service, rate in (ceilings or {}).items() if rate}
+        self._buckets = {service: [rate, time.monotonic()] for service, rate in self.ceilings.items()}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, service, sleep=True):
+        """Count a call, sleep for its latency and return 'error', 'throttle' or None"""
+        with self._lock:
+            self.calls[service] += 1
+            roll = self._random.random()
+            over_ceiling = not self._take_token(service)
+        if sleep and self.latency[service]:
+            time.sleep(self.latency[service])
+        if over_ceiling or roll < self.throttle_rate:
+            return 'throttle'
+        if roll < self.throttle_rate + self.error_rate:
+            return 'error'
+        return None
+
+    def _take_token(self, service):
+        bucket = self._buckets.get(service)
+        if bucket is None:
+            return True
+        now = time.monotonic()
+        bucket[0] = min(self.ceilings[service], bucket[0] + (now - bucket[1]) * self.ceilings[service])
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+class FakeClientError(Exception):
+    """Mimics botocore's ClientError shape (error.response['Error']['Code'])"""
+
+    def __init__(self, code, message=''):
+        super().__init__(f"An error occurred ({code}): {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+class FakeStreamingBody:
+    def __init__(self, payload):
+        self._payload = json.dumps(payload).encode('utf-8')
+
+    def read(self):
+        return self._payload
+
+class FakeEventStream:
+    """Iterable of Bedrock response-stream events, closable mid-stream"""
+
+    CHUNK_CHARS = 24
+
+    def __init__(self, generation, prompt_tokens, latency):
+        self.generation = generation
+        self.prompt_tokens = prompt_tokens
+        self.latency = latency
+        self.closed = False
+
+    def __iter__(self):
+        chunks = [self.generation[i:i + self.CHUNK_CHARS] for i in range(0, len(self.generation), self.CHUNK_CHARS)]
+        per_chunk = self.latency * 0.75 / max(1, len(chunks))
+        if self.latency:
+            time.sleep(self.latency * 0.25)
+
+        for i, piece in enumerate(chunks):
+            if self.closed:
+                return
+            if per_chunk:
+                time.sleep(per_chunk)
+            last = i == len(chunks) - 1
+            payload = {
+                'generation': piece,
+                'prompt_token_count': self.prompt_tokens if i == 0 else None,
+                'generation_token_count': (i + 1) * self.CHUNK_CHARS // 4,
+                'stop_reason': 'stop' if last else None
+            }
+            yield {'chunk': {'bytes': json.dumps(payload).encode('utf-8')}}
+
+    def close(self):
+        self.closed = True
+
+class FakeBedrock:
+    """Stand-in for the bedrock-runtime client"""
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def invoke_model(self, modelId, body, contentType=None, **kwargs):
+        self._check()
+        request = json.loads(body)
+
+        if 'embed' in modelId:
+            return {'body': FakeStreamingBody({'embedding': fake_embedding(request['inputText'], request.get('dimensions', 256))})}
+
+        prompt = request['prompt']
+        generation = fake_generation(prompt)
+        return {'body': FakeStreamingBody({
+            'generation': generation,
+            'prompt_token_count': len(prompt) // 4,
+            'generation_token_count': len(generation) // 4,
+            'stop_reason': 'stop'
+        })}
+
+    def invoke_model_with_response_stream(self, modelId, body, contentType=None, **kwargs):
+        """Stream the same generation in small chunks; a quarter of the latency is time to first token"""
+        outcome = self.profile.call('bedrock', sleep=False)
+        if outcome == 'throttle':
+            raise FakeClientError('ThrottlingException', 'Too many requests')
+        if outcome == 'error':
+            raise FakeClientError('ModelErrorException', 'Injected failure')
+
+        prompt = json.loads(body)['prompt']
+        return {'body': FakeEventStream(fake_generation(prompt), len(prompt) // 4, self.profile.latency['bedrock'])}
+
+    def _check(self):
+        outcome = self.profile.call('bedrock')
+        if outcome == 'throttle':
+            raise FakeClientError('ThrottlingException', 'Too many requests')
+        if outcome == 'error':
+            raise FakeClientError('ModelErrorException', 'Injected failure')
+
+def fake_generation(prompt):
+    """Produce a plausible Llama response for the prompts the Lambdas send"""
+    if 'JSON object mapping each topic number' in prompt:
+        section = prompt.split('Now generate keywords for these topics:')[1]
+        topics = re.findall(r'^(\d+)\. "(.*)"$', section, re.MULTILINE)
+        keywords = json.dumps({number: fake_keywords(topic) for number, topic in topics})
+        return f"{keywords}\n\nEach list mixes broad and specific terms for news search."
+
+
+    if 'Now generate keywords for:' in prompt:
+        topic = re.search(r'Now generate keywords for: "(.*)"', prompt).group(1)
+        return ', '.join(fake_keywords(topic)) + "\n\nThese keywords cover the core subject and related terms."
+
+
+    topic = re.search(r'interested in: "(.*)"', prompt)
+    topic = topic.group(1) if topic else 'news'
+    titles = re.findall(r'^Title: (.*)$', prompt, re.MULTILINE)[:6]
+    bullets = ''.join(f'<li>{title}</li>' for title in titles)
+    return (
+        f"SUBJECT: Your Daily Pickle 🥒 on {topic}\n"
+        f"HTML: <html><body><h2>Welcome to your Daily Pickle on {topic}!</h2>"
+        f"<h3>Daily Recap:</h3><ul>{bullets}</ul>"
+        f"<p><strong>Thanks for reading the Pickle, see you tomorrow!</strong></p></body></html>"
+        "\n\nI hope this digest meets your needs! Let me know if you would like any changes."
+    )
+
+def fake_keywords(topic):
+    """Deterministic keywords: topic words plus shared vocabulary"""
+    seed = zlib.crc32(topic.lower().encode('utf-8'))
+    words = [word for word in re.findall(r'\w+', topic) if len(word) >= 2]
+    shared = [SHARED_VOCAB[(seed >> shift) % len(SHARED_VOCAB)] for shift in (0, 5, 10)]
+    keywords = [topic.strip()] + words + shared
+    return list(dict.fromkeys(keywords))[:7]
+
+def fake_embedding(text, dimensions):
+    rng = random.Random(zlib.crc32(text.encode('utf-8')))
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector]
+
+class FakeNewsAPIServer:
+    """Local HTTP server answering NewsAPI /v2/everything requests"""
+
+    def __init__(self, profile, articles_per_query=30):
+        self.profile = profile
+        self.articles_per_query = articles_per_query
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/v2/everything"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send headers and body as one segment (avoids Nagle/delayed-ACK stalls)
+            disable_nagle_algorithm = True
+            wbufsize = 1 << 16
+
+            def do_GET(self):
+                outcome = fake.profile.call('news')
+                if outcome == 'throttle':
+                    return self._send(429, {'status': 'error', 'code': 'rateLimited'}, {'Retry-After': '1'})
+                if outcome == 'error':
+                    return self._send(500, {'status': 'error', 'code': 'unexpectedError'})
+
+                params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                # The Lambda pre-quotes the keyword, so it arrives encoded once more
+                query = urllib.parse.unquote(params.get('q', [''])[0])
+                page_size = int(params.get('pageSize', [fake.articles_per_query])[0])
+                since = params.get('from', [None])[0]
+                until = params.get('to', [None])[0]
+                articles = fake_articles(query, min(page_size, fake.articles_per_query), since, until)
+                self._send(200, {'status': 'ok', 'totalResults': len(articles), 'articles': articles})
+
+            def _send(self, status, payload, headers=None):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+def fake_articles(query, count, since=None, until=None):
+    """Deterministic articles for a query, including syndicated duplicates"""
+    slug = re.sub(r'\W+', '-', query.lower()).strip('-') or 'news'
+    now = datetime.now(timezone.utc)
+    articles = []
+
+    for i in range(count):
+        published = now - timedelta(hours=i * 5)
+        # Every fourth article is a wire story shared across queries
+        if i % 4 == 0:
+            wire_id = i // 4
+            url = f"https://wire.example/story-{wire_id}-{slug}"
+            title = f"Wire report {wire_id}: {query} and markets react"
+            source = 'Associated Press'
+        else:
+            url = f"https://news.example/{slug}/{i}"
+            title = f"{query.title()} update {i}: what it means"
+            source = f"Outlet {i % 7}"
+
+        articles.append({
+            'source': {'id': None, 'name': source},
+            'author': None,
+            'title': title,
+            'description': f"The latest on {query}, with analysis of {query} coverage and reactions." if i % 9 else None,
+            'url': url,
+            'urlToImage': None,
+            'publishedAt': published.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'content': f"{query} developments continued today as analysts weighed in on {query} ... [+{1200 + i} chars]"
+        })
+
+    if since:
+        articles = [article for article in articles if article['publishedAt'] >= since]
+    if until:
+        # 'to' is inclusive; compare the date-time part only
+        articles = [article for article in articles if article['publishedAt'][:len(until)] <= until]
+    return articles
+
+class InMemoryTable:
+    """Thread-safe in-memory stand-in for a boto3 DynamoDB Table.
+
+    Scans and queries keep sorted key lists (per scan segment, and per
+    query for as long as it is paged) and resume from ExclusiveStartKey by
+    bisection, so paging through the table costs O(n log n) overall rather
+    than a full re-sort on every page.
+    """
+
+    def __init__(self, name, key_schema, indexes, profile):
+        self.name = name
+        self.key_schema = key_schema
+        self.indexes = indexes
+        self.profile = profile
+        self.items = {}
+        self._lock = threading.Lock()
+        self._key_version = 0
+        self._key_lists = {}
+
+    def _key(self, item):
+        return tuple(item[attribute] for attribute in self.key_schema)
+
+    def _store(self, item):
+        # Caller holds the lock
+        key = self._key(item)
+        if key not in self.items:
+            self._key_version += 1
+        self.items[key] = normalize_numbers(dict(item))
+
+    def put_item(self, Item, **kwargs):
+        self._call()
+        with self._lock:
+            self._store(Item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        self._call()
+        with self._lock:
+            item = self.items.get(self._key(Key))
+        return {'Item': dict(item)} if item else {}
+
+    def delete_item(self, Key, **kwargs):
+        self._call()
+        with self._lock:
+            if self.items.pop(self._key(Key), None) is not None:
+                self._key_version += 1
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ConditionExpression=None, **kwargs):
+        self._call()
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        with self._lock:
+            if self._key(Key) not in self.items:
+                self._key_version += 1
+            item = self.items.setdefault(self._key(Key), dict(Key))
+            if ConditionExpression and not matches(item, ConditionExpression, names, values):
+                raise FakeClientError('ConditionalCheckFailedException', 'The conditional request failed')
+            for assignment in UpdateExpression.replace('SET ', '', 1).split(','):
+                attribute, value = [part.strip() for part in assignment.split('=')]
+                item[names.get(attribute, attribute)] = values.get(value, value)
+        return {}
+
+    def scan(self, Limit=None, ExclusiveStartKey=None, Segment=0, TotalSegments=1,
+             FilterExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        self._call()
+        with self._lock:
+            segments = self._sorted_keys(('scan', TotalSegments), lambda: self._split_segments(TotalSegments))
+            return self._page(segments.get(Segment, []), Limit, ExclusiveStartKey, FilterExpression,
+                              ExpressionAttributeNames, ExpressionAttributeValues, self.key_schema)
+
+    def query(self, KeyConditionExpression, IndexName=None, Limit=None, ExclusiveStartKey=None,
+              FilterExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        self._call()
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        key_schema = self.indexes[IndexName] if IndexName else self.key_schema
+
+        def key_condition(item):
+            return matches(item, KeyConditionExpression, names, values)
+
+        with self._lock:
+            # Matching keys are collected once per query and reused while it is paged
+            cache_key = ('query', IndexName, KeyConditionExpression, repr(sorted(values.items())))
+            if not ExclusiveStartKey:
+                self._key_lists.pop(cache_key, None)
+            keys = self._sorted_keys(cache_key, lambda: sorted(
+                key for key, item in self.items.items() if key_condition(item)
+            ))
+            return self._page(keys, Limit, ExclusiveStartKey, FilterExpression, names, values,
+                              self.key_schema + [a for a in key_schema if a not in self.key_schema],
+                              key_condition)
+
+    def _sorted_keys(self, cache_key, build):
+        # Rebuilt whenever keys are added or removed; in-place updates keep it valid
+        stamp = (self._key_version, len(self.items))
+        cached = self._key_lists.get(cache_key)
+        if cached is None or cached[0] != stamp:
+            cached = self._key_lists[cache_key] = (stamp, build())
+        return cached[1]
+
+    def _split_segments(self, total_segments):
+        segments = {}
+        for key in self.items:
+            segments.setdefault(zlib.crc32(repr(key).encode()) % total_segments, []).append(key)
+        for keys in segments.values():
+            keys.sort()
+        return segments
+
+    def _page(self, keys, limit, start_key, filter_expression, names, values, page_key_attributes,
+              key_condition=None):
+        position = bisect.bisect_right(keys, self._key(start_key)) if start_key else 0
+
+        # Items updated out of a query's key condition since it started are skipped
+        evaluated = []
+        while position < len(keys) and not (limit and len(evaluated) >= limit):
+            key = keys[position]
+            position += 1
+            item = self.items.get(key)
+            if item is not None and (key_condition is None or key_condition(item)):
+                evaluated.append(key)
+
+        items = [dict(self.items[key]) for key in evaluated]
+        if filter_expression:
+            items = [item for item in items if matches(item, filter_expression, names or {}, values or {})]
+
+        response = {'Items': items, 'Count': len(items), 'ScannedCount': len(evaluated)}
+        if limit and evaluated and position < len(keys):
+            last = self.items[evaluated[-1]]
+            response['LastEvaluatedKey'] = {attribute: last[attribute] for attribute in page_key_attributes}
+        return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return InMemoryBatchWriter(self)
+
+    def _call(self):
+        # boto3 retries DynamoDB throttles itself, so they surface as an extra round trip
+        while self.profile.call('dynamodb') == 'throttle':
+            pass
+
+class InMemoryBatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.items = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # One simulated round trip per 25 items, like BatchWriteItem
+        for i in range(0, len(self.items), 25):
+            self.table._call()
+            with self.table._lock:
+                for item in self.items[i:i + 25]:
+                    self.table._store(item)
+        return False
+
+    def put_item(self, Item):
+        self.items.append(Item)
+
+def normalize_numbers(item):
+    """Store numbers as Decimal, as boto3 returns them"""
+    for key, value in item.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            item[key] = Decimal(str(value))
+    return item
+
+def matches(item, expression, names, values):
+    """Evaluate 'a = :x AND #b = :y' style expressions"""
+    for clause in re.split(r'\s+AND\s+', expression.strip(), flags=re.IGNORECASE):
+        attribute, placeholder = [part.strip() for part in clause.split('=')]
+        if item.get(names.get(attribute, attribute)) != values.get(placeholder):
+            return False
+    return True
+
+DIGESTS_TABLE = 'pickle-user-digests'
+
+class InMemoryDynamoDB:
+    """Stand-in for boto3.resource('dynamodb') holding all Pickle tables"""
+
+    KEY_SCHEMAS = {
+        'pickle-user-subscriptions': (['email'], {}),
+        'pickle-user-digests': (['email', 'digest_date'], {
+            'status-digest_date-index': ['status', 'digest_date']
+        }),
+        'pickle-keyword-cache': (['topic_key'], {}),
+        'pickle-run-checkpoints': (['run_id'], {})
+    }
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def Table(self, name):
+        with self._lock:
+            if name not in self.tables:
+                key_schema, indexes = self.KEY_SCHEMAS.get(name, (['id'], {}))
+                self.tables[name] = InMemoryTable(name, key_schema, indexes, self.profile)
+            return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            table._call()
+            with table._lock:
+                found = [table.items.get(table._key(key)) for key in request['Keys']]
+            responses[name] = [dict(item) for item in found if item]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+class FakeDynamoDBClient:
+    """Low-level client stand-in for put_item and the PartiQL status and watermark updates"""
+
+    UPDATE = re.compile(
+        r'UPDATE "(?P<table>[^"]+)" SET "status" = \? SET "(?P<stamp>\w+)" = \? '
+        r'WHERE "email" = \? AND "digest_date" = \? AND "status" = \?(?: AND "(?P<guard>\w+)" = \?)?'
+    )
+    WATERMARK = re.compile(
+        r'UPDATE "(?P<table>[^"]+)" SET "last_processed" = \? SET "recent_urls" = \? '
+        r'WHERE "email" = \? AND "topic" = \?'
+    )
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def put_item(self, TableName, Item, **kwargs):
+        item = {
+            name: Decimal(value['N']) if 'N' in value else value['S']
+            for name, value in Item.items()
+        }
+        return self.resource.Table(TableName).put_item(Item=item)
+
+    def batch_execute_statement(self, Statements):
+        self.resource.Table(DIGESTS_TABLE)._call()
+        responses = []
+        for statement in Statements:
+            watermark = self.WATERMARK.match(statement['Statement'])
+            if watermark:
+                responses.append(self._update_watermark(watermark.group('table'), statement['Parameters']))
+                continue
+
+            match = self.UPDATE.match(statement['Statement'])
+            to_status, stamp, email, digest_date, from_status, *guard = [p['S'] for p in statement['Parameters']]
+            table = self.resource.Table(match.group('table'))
+            with table._lock:
+                item = table.items.get((email, digest_date))
+                if (not item or item.get('status') != from_status
+                        or (guard and item.get(match.group('guard')) != guard[0])):
+                    responses.append({'Error': {'Code': 'ConditionalCheckFailed'}})
+                    continue
+                item['status'] = to_status
+                item[match.group('stamp')] = stamp
+            responses.append({})
+        return {'Responses': responses}
+
+    def _update_watermark(self, table_name, parameters):
+        last_processed, recent_urls, email, topic = parameters
+        table = self.resource.Table(table_name)
+        with table._lock:
+            item = table.items.get((email['S'],))
+            if not item or item.get('topic') != topic['S']:
+                return {'Error': {'Code': 'ConditionalCheckFailed'}}
+            item['last_processed'] = last_processed['S']
+            item['recent_urls'] = [url['S'] for url in recent_urls['L']]
+        return {}
+
+class FakeSES:
+    """Stand-in for the SES client"""
+
+    def __init__(self, profile, max_send_rate=14.0):
+        self.profile = profile
+        self.max_send_rate = max_send_rate
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def get_send_quota(self):
+        return {'Max24HourSend': 1e9, 'MaxSendRate': self.max_send_rate, 'SentLast24Hours': 0}
+
+    def send_email(self, Source, Destination, Message, **kwargs):
+        outcome = self.profile.call('ses')
+        if outcome == 'throttle':
+            raise FakeClientError('Throttling', 'Maximum sending rate exceeded.')
+        if outcome == 'error':
+            raise FakeClientError('MessageRejected', 'Injected failure')
+        with self._lock:
+            self.sent += 1
+            message_id = f"fake-{self.sent}"
+        return {'MessageId': message_id}
+
+class FakeLambdaClient:
+    """Records self-invocations (checkpoint resumes, worker dispatch)"""
+
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+        return {'StatusCode': 202}
+
+class FakeContext:
+    """Minimal Lambda context with a configurable time budget"""
+
+    function_name = 'pickle-bench'
+    invoked_function_arn = 'arn:aws:lambda:us-east-2:000000000000:function:pickle-bench'
+
+    def __init__(self, timeout_ms):
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+class StageTimer:
+    """Wraps module functions to record call counts and wall time"""
+
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, module, label, names):
+        for name in names:
+            original = getattr(module, name, None)
+            if original is None:
+                continue
+            setattr(module, name, self._timed(f"{label}.{name}", original))
+
+    def _timed(self, stage, func):
+        timer = self
+
+        if func.__code__.co_flags & 0x20:  # Generator function
+            def timed_generator(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    yield from func(*args, **kwargs)
+                finally:
+                    timer.record(stage, time.perf_counter() - started)
+            return timed_generator
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.record(stage, time.perf_counter() - started)
+        return timed
+
+    def record(self, stage, seconds):
+        with self._lock:
+            entry = self.stats.setdefault(stage, {'calls': 0, 'total_s': 0.0, 'max_s': 0.0})
+            entry['calls'] += 1
+            entry['total_s'] += seconds
+            entry['max_s'] = max(entry['max_s'], seconds)
+
+def load_lambda(name, unique_suffix):
+    """Import a Lambda's lambda-function.py as a fresh module"""
+    path = os.path.join(REPO_ROOT, name, 'lambda-function.py')
+    module_name = f"{name.replace('-', '_')}_{unique_suffix}"
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def synthetic_topics(count, seed):
+    """Topics with a long tail: a few popular subjects in several phrasings"""
+    rng = random.Random(seed)
+    phrasings = ['{}', '{} news', 'latest {} updates', 'keep me informed about {}', '{}!']
+    topics = []
+    for _ in range(count):
+        # Zipf-like popularity over the base topics, plus a long tail of niche ones
+        if rng.random() < 0.85:
+            index = min(int(rng.paretovariate(1.2)) - 1, len(BASE_TOPICS) - 1)
+            topics.append(rng.choice(phrasings).format(BASE_TOPICS[index]))
+        else:
+            topics.append(f"niche topic {rng.randint(0, count // 10 + 10)}")
+    return topics
+
+def run_population(users, args):
+    """Run the three Lambdas end to end for one population size"""
+    profile_settings = dict(PROFILES[args.profile])
+    for key in ('bedrock_ms', 'news_ms', 'dynamodb_ms', 'ses_ms'):
+        override = getattr(args, key)
+        profile_settings[key] = (override if override is not None else profile_settings[key]) * args.latency_scale
+    for key in ('error_rate', 'throttle_rate'):
+        override = getattr(args, key)
+        if override is not None:
+            profile_settings[key] = override
+    ceilings = {'news': args.news_ceiling, 'bedrock': args.bedrock_ceiling}
+    profile = ServiceProfile(seed=args.seed, ceilings=ceilings, **profile_settings)
+
+    dynamodb = InMemoryDynamoDB(profile)
+    bedrock = FakeBedrock(profile)
+    ses = FakeSES(profile, args.ses_rate)
+    lambda_client = FakeLambdaClient()
+    timer = StageTimer()
+    suffix = f"{users}_{int(time.time() * 1000)}"
+
+    with FakeNewsAPIServer(profile) as news_server:
+        os.environ['NEWS_API_URL'] = news_server.url
+        os.environ.setdefault('NEWS_API_KEY', 'bench')
+        # The Lambdas' own rate ceilings; by default the fake providers' ceilings, if any
+        for variable, rate, ceiling in (
+            ('NEWS_API_MAX_RATE', args.news_max_rate, args.news_ceiling),
+            ('BEDROCK_MAX_RATE', args.bedrock_max_rate, args.bedrock_ceiling)
+        ):
+            os.environ[variable] = str(rate or ceiling or 1e6)
+
+        insertion = load_lambda('pickle-user-insertion', suffix)
+        prompt = load_lambda('pickle-user-prompt', suffix)
+        email = load_lambda('pickle-email', suffix)
+
+        inject_fakes(insertion, prompt, email, dynamodb, bedrock, ses, lambda_client)
+        timer.wrap(insertion, 'insertion', STAGES['pickle-user-insertion'])
+        timer.wrap(prompt, 'prompt', STAGES['pickle-user-prompt'])
+        timer.wrap(email, 'email', STAGES['pickle-email'])
+        counters = capture_counters(insertion, prompt, email)
+
+        results = {'users': users, 'profile': profile_settings, 'phases': {}}
+        if args.trace_memory:
+            tracemalloc.start()
+
+        topics = synthetic_topics(users, args.seed)
+        phases = [
+            ('insertion', lambda: [
+                insertion.lambda_handler({'body': json.dumps({'email': f"user{i}@bench.example", 'topic': topic})}, None)
+                for i, topic in enumerate(topics)
+            ][-1]),
+            ('prompt', lambda: prompt.lambda_handler(
+                {'execution_mode': args.execution_mode}, FakeContext(args.timeout_ms)
+            )),
+            ('email', lambda: email.lambda_handler({}, FakeContext(args.timeout_ms)))
+        ]
+
+        for phase, run in phases:
+            calls_before = dict(profile.calls)
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO() if not args.verbose else sys.stdout):
+                response = run()
+            elapsed = time.perf_counter() - started
+
+            results['phases'][phase] = {
+                'wall_s': round(elapsed, 3),
+                'calls_per_user': {
+                    service: round((profile.calls[service] - calls_before[service]) / users, 3)
+                    for service in profile.calls
+                },
+                'response': json.loads(response['body']) if 'body' in response else response
+            }
+
+        if args.trace_memory:
+            results['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            tracemalloc.stop()
+
+        results['stages'] = {
+            stage: {
+                'calls': entry['calls'],
+                'total_s': round(entry['total_s'], 3),
+                'mean_ms': round(entry['total_s'] / entry['calls'] * 1000, 3),
+                'max_ms': round(entry['max_s'] * 1000, 3)
+            }
+            for stage, entry in sorted(timer.stats.items())
+        }
+        results['counters'] = dict(sorted(counters.items()))
+        results['emails_sent'] = ses.sent
+        results['resume_invocations'] = len(lambda_client.invocations)
+
+        for module in (insertion, prompt, email):
+            sys.modules.pop(module.__name__, None)
+
+    return results
+
+def capture_counters(*modules):
+    """Accumulate each Lambda's metrics counters as they are flushed"""
+    counters = {}
+    lock = threading.Lock()
+
+    for module in modules:
+        def flush(context=None, original=module.metrics.flush):
+            summary = original(context)
+            with lock:
+                for name, value in summary['counters'].items():
+                    counters[name] = counters.get(name, 0) + value
+            return summary
+        module.metrics.flush = flush
+    return counters
+
+def inject_fakes(insertion, prompt, email, dynamodb, bedrock, ses, lambda_client):
+    """Point the Lambda modules' AWS clients at the local fakes"""
+    insertion.dynamodb_client = FakeDynamoDBClient(dynamodb)
+
+    prompt.dynamodb_client = FakeDynamoDBClient(dynamodb)
+    prompt.bedrock = bedrock
+    prompt.lambda_client = lambda_client
+    prompt.new_dynamodb_resource = lambda: dynamodb
+
+    email.dynamodb = dynamodb
+    email.ses = ses
+    email.dynamodb_client = FakeDynamoDBClient(dynamodb)
+
+def print_report(results):
+    print(f"\n=== {results['users']:,} subscribers ===")
+    for phase, data in results['phases'].items():
+        calls = ', '.join(f"{service} {count}" for service, count in data['calls_per_user'].items() if count)
+        print(f"{phase:<10} wall {data['wall_s']:>9.3f}s   calls/user: {calls or '-'}")
+
+    print(f"{'stage':<45}{'calls':>10}{'total s':>12}{'mean ms':>12}{'max ms':>12}")
+    for stage, entry in results['stages'].items():
+        print(f"{stage:<45}{entry['calls']:>10}{entry['total_s']:>12.3f}{entry['mean_ms']:>12.3f}{entry['max_ms']:>12.3f}")
+
+    resilience = {
+        name: value for name, value in results['counters'].items()
+        if name.rsplit('.', 1)[-1] in ('throttles', 'retries', 'shed', 'circuit_opened', 'errors')
+    }
+    if resilience:
+        print('retries and throttling: ' + ', '.join(f"{name} {value:,}" for name, value in resilience.items()))
+
+    if 'peak_memory_mb' in results:
+        print(f"peak traced memory: {results['peak_memory_mb']} MB")
+    print(f"emails sent: {results['emails_sent']:,}   resume invocations: {results['resume_invocations']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[100, 1000],
+                        help='Population sizes to run (100 to 1,000,000)')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='instant')
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='Multiply all fake latencies, e.g. 0.01 for quick realistic-shaped runs')
+    parser.add_argument('--bedrock-ms', type=float)
+    parser.add_argument('--news-ms', type=float)
+    parser.add_argument('--dynamodb-ms', type=float)
+    parser.add_argument('--ses-ms', type=float)
+    parser.add_argument('--error-rate', type=float)
+    parser.add_argument('--throttle-rate', type=float)
+    parser.add_argument('--ses-rate', type=float, default=1000.0, help='Fake SES MaxSendRate')
+    parser.add_argument('--news-ceiling', type=float, help='Requests/s the fake News API accepts before 429s')
+    parser.add_argument('--bedrock-ceiling', type=float, help='Requests/s the fake Bedrock accepts before throttling')
+    parser.add_argument('--news-max-rate', type=float,
+                        help="NEWS_API_MAX_RATE for the prompt Lambda (default: --news-ceiling, else unlimited)")
+    parser.add_argument('--bedrock-max-rate', type=float,
+                        help="BEDROCK_MAX_RATE for the prompt Lambda (default: --bedrock-ceiling, else unlimited)")
+    parser.add_argument('--execution-mode', choices=['sequential', 'pipelined'], default='sequential')
+    parser.add_argument('--timeout-ms', type=int, default=10 ** 9,
+                        help='Lambda time budget; lower it to exercise checkpointing')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false',
+                        help='Skip tracemalloc (faster, no peak memory figure)')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', help='Write results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help="Show the Lambdas' own logs")
+    args = parser.parse_args(argv)
+
+    all_results = []
+    for users in args.users:
+        results = run_population(users, args)
+        print_report(results)
+        all_results.append(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_results, f, indent=2, default=str)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Cold-start benchmark: module import and first-invocation latency per Lambda.
+
+Each sample is a fresh Python process that imports one lambda-function.py
+and invokes its handler once, as a new Lambda container would. AWS calls
+are real boto3 requests sent to a local stub endpoint (AWS_ENDPOINT_URL),
+so client creation, request signing and connection setup are all paid as
+in production; the stub answers every call with an empty JSON object.
+
+Two trees are compared: the working tree ("after") and a git ref
+("before", by default the commit before the shared runtime module was
+added). Requires boto3 (and requests, for the "before" tree) installed.
+
+Usage:
+    python pickle-bench/coldstart.py --samples 30
+    python pickle-bench/coldstart.py --before-ref HEAD~1 --functions pickle-user-insertion
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNTIME_MODULE = 'pickle-layer/python/pickle_runtime.py'
+
+FUNCTIONS = ['pickle-user-insertion', 'pickle-user-prompt', 'pickle-email']
+
+EVENTS = {
+    'pickle-user-insertion': {'body': json.dumps({'email': 'cold@bench.example', 'topic': 'space exploration'})},
+    'pickle-user-prompt': {},
+    'pickle-email': {}
+}
+
+# Runs inside each sample process; prints one JSON line of timings
+DRIVER = r"""
+import importlib.util, io, json, sys, time, contextlib
+started = time.perf_counter()
+path, event = sys.argv[1], json.loads(sys.argv[2])
+
+class Context:
+    aws_request_id = 'coldstart'
+    function_name = 'coldstart'
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+with contextlib.redirect_stdout(io.StringIO()):
+    spec = importlib.util.spec_from_file_location('lambda_function', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    imported = time.perf_counter()
+    module.lambda_handler(event, Context())
+    invoked = time.perf_counter()
+    module.lambda_handler(event, Context())
+    warm = time.perf_counter()
+
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_invoke_ms': (invoked - imported) * 1000,
+    'warm_invoke_ms': (warm - invoked) * 1000,
+    'modules_loaded': len(sys.modules)
+}))
+"""
+
+class StubAWSEndpoint:
+    """Answers every AWS API request with 200 and an empty JSON body"""
+
+    def __init__(self):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send headers and body as one segment (avoids Nagle/delayed-ACK stalls)
+            disable_nagle_algorithm = True
+            wbufsize = 1 << 16
+
+            def _reply(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                body = b'{}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-amz-json-1.0')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _reply
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def default_before_ref():
+    """The parent of the commit that added the shared runtime module"""
+    added = subprocess.run(
+        ['git', 'log', '--diff-filter=A', '--format=%H', '-1', '--', RUNTIME_MODULE],
+        cwd=REPO_ROOT, capture_output=True, text=True, check=True
+    ).stdout.strip()
+    return f"{added}^" if added else 'HEAD'
+
+def export_tree(ref, target):
+    """Write the files of a git ref into target"""
+    archive = subprocess.run(['git', 'archive', ref], cwd=REPO_ROOT, capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', target], input=archive, check=True)
+
+def sample(tree, function, endpoint_url):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': os.pathsep.join(filter(None, [os.path.join(tree, 'pickle-layer', 'python'), env.get('PYTHONPATH')])),
+        'AWS_ENDPOINT_URL': endpoint_url,
+        'AWS_ACCESS_KEY_ID': 'coldstart',
+        'AWS_SECRET_ACCESS_KEY': 'coldstart',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        'NEWS_API_KEY': 'coldstart',
+        'NEWS_API_URL': f"{endpoint_url}/v2/everything",
+        'RESUME_SELF_INVOKE': 'false'
+    })
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', DRIVER, os.path.join(tree, function, 'lambda-function.py'), json.dumps(EVENTS[function])],
+        env=env, capture_output=True, text=True
+    )
+    process_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"{function} sample failed:\n{result.stderr}")
+
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process_ms'] = process_ms
+    return timings
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(samples):
+    return {
+        metric: {
+            'p50': round(percentile([s[metric] for s in samples], 50), 1),
+            'p99': round(percentile([s[metric] for s in samples], 99), 1)
+        }
+        for metric in ('import_ms', 'first_invoke_ms', 'warm_invoke_ms', 'process_ms', 'modules_loaded')
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=20, help='Fresh processes per function and tree')
+    parser.add_argument('--before-ref', help='Git ref for the "before" tree')
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS, default=FUNCTIONS)
+    parser.add_argument('--json', help='Write results to this JSON file')
+    args = parser.parse_args(argv)
+
+    before_ref = args.before_ref or default_before_ref()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as before_tree, StubAWSEndpoint() as endpoint:
+        export_tree(before_ref, before_tree)
+        trees = {f"before ({before_ref})": before_tree, 'after (working tree)': REPO_ROOT}
+
+        for function in args.functions:
+            results[function] = {}
+            # Interleave trees so machine noise hits both equally
+            samples = {label: [] for label in trees}
+            for _ in range(args.samples):
+                for label, tree in trees.items():
+                    samples[label].append(sample(tree, function, endpoint.url))
+            for label in trees:
+                results[function][label] = summarize(samples[label])
+
+    for function, by_tree in results.items():
+        print(f"\n=== {function} ({args.samples} cold starts each) ===")
+        print(f"{'tree':<32}{'import p50/p99':>20}{'1st call p50/p99':>20}{'warm p50/p99':>18}{'process p50/p99':>20}{'modules':>9}")
+        for label, stats in by_tree.items():
+            cells = [f"{stats[m]['p50']:.1f}/{stats[m]['p99']:.1f}" for m in ('import_ms', 'first_invoke_ms', 'warm_invoke_ms', 'process_ms')]
+            print(f"{label:<32}{cells[0]:>20}{cells[1]:>20}{cells[2]:>18}{cells[3]:>20}{stats['modules_loaded']['p50']:>9.0f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
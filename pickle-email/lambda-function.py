@@ -1,62 +1,231 @@
+import itertools
 import json
-import boto3
-from datetime import datetime
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+import pickle_runtime
+from pickle_metrics import Metrics
+from pickle_resilience import AdaptiveRateLimiter
 
 # Configuration
 REGION = "us-east-2"
 FROM_EMAIL = "digest@pickle.anjie.cafe"
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb', region_name=REGION)
-ses = boto3.client('ses', region_name=REGION)
+# Concurrent delivery settings
+SEND_CONCURRENCY = int(os.environ.get('SEND_CONCURRENCY', '10'))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', '5'))
+DEFAULT_SEND_RATE = 1.0  # Sandbox SES limit, used if get_send_quota fails
+
+# Ready digests are read page by page from a GSI keyed on (status, digest_date)
+READY_DIGESTS_INDEX = 'status-digest_date-index'
+READY_PAGE_LIMIT = int(os.environ.get('READY_PAGE_LIMIT', '100'))
+SENDABLE_ATTRIBUTES = ('email', 'digest_date', 'subject_line', 'html_content')  # The GSI must project these
+
+# Claims older than this belong to an invocation that died; longer than the 15-minute Lambda limit
+SENDING_RECLAIM_MINUTES = int(os.environ.get('SENDING_RECLAIM_MINUTES', '20'))
+
+# The catch-up pass stops claiming this close to the timeout, leaving time for sends in flight
+SEND_DEADLINE_MARGIN_MS = int(os.environ.get('SEND_DEADLINE_MARGIN_MS', '60000'))
+
+# Status transitions are applied in PartiQL batches of up to 25 statements
+STATUS_BATCH_SIZE = 25
+STATUS_MAX_RETRIES = int(os.environ.get('STATUS_MAX_RETRIES', '3'))
+
+# Stream-driven delivery sends new digests in micro-batches as they land
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', '25'))
+STREAM_BATCH_WINDOW_SECONDS = float(os.environ.get('STREAM_BATCH_WINDOW_SECONDS', '2'))
+
+# Stage timings and counters, emitted as CloudWatch EMF after each invocation
+metrics = Metrics('pickle-email')
+
+# AWS clients are created on first use; stream batches never touch the resource
+dynamodb = pickle_runtime.resource('dynamodb', region_name=REGION)
+ses = pickle_runtime.client('ses', region_name=REGION)
+dynamodb_client = pickle_runtime.client('dynamodb', region_name=REGION)
 
 DIGESTS_TABLE = 'pickle-user-digests'
 
+deserializer = pickle_runtime.dynamodb_deserializer()
+
+class DigestStatusUpdater:
+    """Buffers digest status transitions and applies them in PartiQL batches.
+    
+    Each transition is a conditional UPDATE on the full (email, digest_date)
+    key that only applies from the expected previous status. Digests are
+    claimed (ready_to_send -> sending) before they are sent, so a rerun or
+    an overlapping invocation can never send the same digest twice. A
+    digest left in 'sending' by a timeout or a lost status update is
+    re-claimed by the catch-up pass once its claim is stale; only one
+    invocation can win that, but the digest may be sent a second time if
+    the original send had gone through.
+    """
+    
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self._pending = []
+        self._lock = threading.Lock()
+    
+    def claim(self, digests):
+        """Move digests to 'sending'.
+        
+        Returns (claimed, errored): the digests this invocation now owns, and
+        those whose claim kept failing with a non-conditional error. Digests
+        already claimed or sent by someone else are in neither list.
+        """
+        claimed = []
+        errored = []
+        for i in range(0, len(digests), STATUS_BATCH_SIZE):
+            chunk = digests[i:i + STATUS_BATCH_SIZE]
+            statements = [self._claim_statement(digest) for digest in chunk]
+            
+            for digest, outcome in zip(chunk, self._execute(statements)):
+                if outcome == 'applied':
+                    claimed.append(digest)
+                elif outcome == 'condition_failed':
+                    print(f"Skipping {digest['email']}: digest already claimed or sent")
+                    metrics.increment('digests.already_claimed')
+                else:
+                    print(f"Could not claim digest for {digest['email']}")
+                    errored.append(digest)
+        return claimed, errored
+    
+    def mark_sent(self, digest):
+        self._queue(self._transition(digest, 'sending', 'sent', 'sent_at'))
+    
+    def mark_failed(self, digest):
+        self._queue(self._transition(digest, 'sending', 'failed', 'failed_at'))
+    
+    def flush(self):
+        with self._lock:
+            statements, self._pending = self._pending, []
+        for i in range(0, len(statements), STATUS_BATCH_SIZE):
+            self._execute(statements[i:i + STATUS_BATCH_SIZE])
+    
+    def _queue(self, statement):
+        with self._lock:
+            self._pending.append(statement)
+            if len(self._pending) < STATUS_BATCH_SIZE:
+                return
+            statements, self._pending = self._pending, []
+        self._execute(statements)
+    
+    def _claim_statement(self, digest):
+        if digest.get('status') == 'sending':
+            # A stale claim is taken over only if nobody else has re-claimed it since
+            return self._transition(digest, 'sending', 'sending', 'claimed_at', digest['claimed_at'])
+        return self._transition(digest, 'ready_to_send', 'sending', 'claimed_at')
+    
+    def _transition(self, digest, from_status, to_status, timestamp_attribute, claimed_at=None):
+        statement = (
+            f'UPDATE "{self.table_name}" '
+            f'SET "status" = ? SET "{timestamp_attribute}" = ? '
+            f'WHERE "email" = ? AND "digest_date" = ? AND "status" = ?'
+        )
+        parameters = [
+            {'S': to_status},
+            {'S': datetime.utcnow().isoformat()},
+            {'S': digest['email']},
+            {'S': digest['digest_date']},
+            {'S': from_status}
+        ]
+        if claimed_at is not None:
+            statement += ' AND "claimed_at" = ?'
+            parameters.append({'S': claimed_at})
+        return {'Statement': statement, 'Parameters': parameters}
+    
+    def _execute(self, statements):
+        """Run a batch of statements, retrying retryable errors.
+        
+        Returns one outcome per statement: 'applied', 'condition_failed'
+        (already transitioned) or 'error' if it kept failing.
+        """
+        results = ['error'] * len(statements)
+        remaining = list(range(len(statements)))
+        
+        for attempt in range(STATUS_MAX_RETRIES + 1):
+            if attempt:
+                metrics.increment('dynamodb.status_update_retries')
+                time.sleep(min(2 ** attempt * 0.05, 2) * random.uniform(0.5, 1.5))
+            
+            try:
+                with metrics.timer('status_update_batch'):
+                    response = dynamodb_client.batch_execute_statement(
+                        Statements=[statements[i] for i in remaining]
+                    )
+            except Exception as e:
+                print(f"Error applying status updates: {str(e)}")
+                continue
+            
+            retry = []
+            for i, result in zip(remaining, response['Responses']):
+                error = result.get('Error')
+                if not error:
+                    results[i] = 'applied'
+                elif error.get('Code') == 'ConditionalCheckFailed':
+                    results[i] = 'condition_failed'
+                else:
+                    retry.append(i)
+            
+            remaining = retry
+            if not remaining:
+                break
+        
+        for i in remaining:
+            email = statements[i]['Parameters'][2]['S']
+            print(f"Giving up on status update for {email}")
+        
+        return results
+
+# Reused across warm invocations so stream batches share one send rate
+_limiter = None
+
+def get_limiter():
+    """Return the container's shared SES rate limiter"""
+    global _limiter
+    if _limiter is None:
+        _limiter = AdaptiveRateLimiter(get_max_send_rate())
+    return _limiter
+
 def lambda_handler(event, context):
+    try:
+        return handle_event(event, context)
+    finally:
+        pickle_runtime.report(metrics)
+        metrics.flush(context)
+
+def handle_event(event, context=None):
+    # DynamoDB Streams events carry new digests as they are stored
+    if 'Records' in (event or {}):
+        return handle_stream_event(event)
+    
     print(f"Starting email delivery at {datetime.utcnow()}")
     
     try:
-        # Get all ready-to-send digests
-        ready_digests = get_ready_digests()
-        print(f"Found {len(ready_digests)} digests ready to send")
+        # Scheduled catch-up pass: stream today's ready and stale claimed digests into the sender
+        sent_count, failed_count = deliver_digests(
+            itertools.chain(iter_ready_digests(), iter_stale_digests()), get_limiter(), context
+        )
+        
+        total_count = sent_count + failed_count
+        print(f"Found {total_count} digests ready to send")
         
-        if not ready_digests:
+        if not total_count:
             return {
                 'statusCode': 200,
                 'body': json.dumps({'message': 'No digests ready to send'})
             }
         
-        sent_count = 0
-        failed_count = 0
-        
-        for digest in ready_digests:
-            email = digest['email']
-            subject = digest['subject_line']
-            html_content = digest['html_content']
-            
-            try:
-                # Send email via SES
-                send_email(email, subject, html_content)
-                
-                # Mark as sent in DynamoDB
-                mark_digest_as_sent(digest)
-                
-                sent_count += 1
-                print(f"✅ Sent digest to {email}")
-                
-            except Exception as e:
-                print(f"❌ Failed to send to {email}: {str(e)}")
-                mark_digest_as_failed(digest)
-                failed_count += 1
-                continue
-        
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': f'Email delivery complete',
                 'sent': sent_count,
                 'failed': failed_count,
-                'total': len(ready_digests)
+                'total': total_count
             })
         }
         
@@ -67,23 +236,272 @@ def lambda_handler(event, context):
             'body': json.dumps({'error': str(e)})
         }
 
-def get_ready_digests():
-    """Get all digests with status 'ready_to_send'"""
-    try:
-        table = dynamodb.Table(DIGESTS_TABLE)
-        
-        response = table.scan(
-            FilterExpression='#status = :status',
-            ExpressionAttributeNames={'#status': 'status'},
-            ExpressionAttributeValues={':status': 'ready_to_send'}
-        )
+def handle_stream_event(event):
+    """Deliver digests from a DynamoDB Streams batch as they are produced.
+    
+    Only inserts or updates whose new image is 'ready_to_send' are sent.
+    Digests are still claimed before sending, so stream retries and the
+    scheduled catch-up pass never send the same digest twice. Records whose
+    claim kept erroring are returned in batchItemFailures (the event source
+    mapping needs ReportBatchItemFailures), so Lambda retries from there.
+    """
+    digests = []
+    sequence_numbers = {}
+    for record in event['Records']:
+        digest = digest_from_stream_record(record)
+        if digest:
+            digests.append(digest)
+            sequence_numbers[(digest['email'], digest['digest_date'])] = record['dynamodb']['SequenceNumber']
+    print(f"Stream batch: {len(digests)} of {len(event['Records'])} records ready to send")
+    
+    unclaimed = []
+    sent_count, failed_count = deliver_micro_batches(
+        pickle_runtime.iter_batches(digests, STREAM_BATCH_SIZE), get_limiter(), unclaimed
+    )
+    
+    return {
+        'sent': sent_count,
+        'failed': failed_count,
+        'batchItemFailures': [
+            {'itemIdentifier': sequence_numbers[(digest['email'], digest['digest_date'])]}
+            for digest in unclaimed
+        ]
+    }
+
+def digest_from_stream_record(record):
+    """Return the digest in a stream record if it is ready to send, else None"""
+    if record.get('eventName') not in ('INSERT', 'MODIFY'):
+        return None
+    
+    new_image = record.get('dynamodb', {}).get('NewImage')
+    if not new_image:
+        return None
+    
+    digest = {key: deserializer.deserialize(value) for key, value in new_image.items()}
+    if digest.get('status') != 'ready_to_send':
+        return None
+    return digest
+
+def consume_digest_queue(digest_queue, limiter=None):
+    """Deliver digests from a local queue in micro-batches until None is received.
+    
+    Stands in for DynamoDB Streams locally: a batch is sent once it holds
+    STREAM_BATCH_SIZE digests or STREAM_BATCH_WINDOW_SECONDS pass without
+    filling it. Returns (sent_count, failed_count).
+    """
+    
+    def iter_queue_batches():
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                digest = digest_queue.get(timeout=timeout)
+            except queue.Empty:
+                yield batch
+                batch, deadline = [], None
+                continue
+            
+            if digest is None:
+                break
+            
+            batch.append(digest)
+            if deadline is None:
+                deadline = time.monotonic() + STREAM_BATCH_WINDOW_SECONDS
+            if len(batch) >= STREAM_BATCH_SIZE:
+                yield batch
+                batch, deadline = [], None
         
-        return response.get('Items', [])
+        if batch:
+            yield batch
+    
+    return deliver_micro_batches(iter_queue_batches(), limiter or get_limiter())
+
+def deliver_micro_batches(batches, limiter, unclaimed=None):
+    """Deliver each micro-batch as it arrives; returns (sent_count, failed_count)"""
+    sent_count = 0
+    failed_count = 0
+    
+    for batch in batches:
+        sent, failed = deliver_digests(batch, limiter, unclaimed=unclaimed)
+        sent_count += sent
+        failed_count += failed
+        print(f"Micro-batch delivered: {sent} sent, {failed} failed")
+    
+    return sent_count, failed_count
+
+def iter_ready_digests(digest_date=None):
+    """Stream today's digests with status 'ready_to_send', page by page.
+    
+    Queries the status/digest_date GSI instead of scanning the table, so
+    old sent or failed rows cost no read capacity, and follows
+    LastEvaluatedKey so nothing past the first 1 MB page is missed.
+    """
+    return iter_digests_with_status('ready_to_send', digest_date)
+
+def iter_stale_digests(digest_date=None):
+    """Stream today's digests whose 'sending' claim is older than SENDING_RECLAIM_MINUTES.
+    
+    These were claimed by an invocation that timed out, crashed or could
+    not record the outcome, and would otherwise never be delivered.
+    """
+    cutoff = (datetime.utcnow() - timedelta(minutes=SENDING_RECLAIM_MINUTES)).isoformat()
+    for digest in iter_digests_with_status('sending', digest_date):
+        if digest.get('claimed_at', '') < cutoff:
+            print(f"Re-claiming stale digest for {digest['email']} (claimed at {digest.get('claimed_at')})")
+            metrics.increment('digests.reclaimed')
+            yield digest
+
+def iter_digests_with_status(status, digest_date=None):
+    """Query the status/digest_date GSI for one day's digests in a status.
+    
+    Errors are raised rather than logged: a missing index, or one that does
+    not project the digest content, would otherwise look like a day with
+    nothing to send.
+    """
+    digest_date = digest_date or datetime.utcnow().strftime('%Y-%m-%d')
+    table = dynamodb.Table(DIGESTS_TABLE)
+    
+    query_kwargs = {
+        'IndexName': READY_DIGESTS_INDEX,
+        'KeyConditionExpression': '#status = :status AND digest_date = :digest_date',
+        'ExpressionAttributeNames': {'#status': 'status'},
+        'ExpressionAttributeValues': {
+            ':status': status,
+            ':digest_date': digest_date
+        },
+        'Limit': READY_PAGE_LIMIT
+    }
+    
+    while True:
+        response = table.query(**query_kwargs)
+        for digest in response.get('Items', []):
+            missing = [attribute for attribute in SENDABLE_ATTRIBUTES if attribute not in digest]
+            if missing:
+                raise RuntimeError(f"{READY_DIGESTS_INDEX} does not project {missing}; it needs projection ALL")
+            yield digest
         
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            break
+        query_kwargs['ExclusiveStartKey'] = last_key
+
+def get_max_send_rate():
+    """Read the account's SES max send rate (emails per second)"""
+    try:
+        quota = ses.get_send_quota()
+        max_rate = float(quota['MaxSendRate'])
+        print(f"SES max send rate: {max_rate}/s")
+        return max_rate
     except Exception as e:
-        print(f"Error fetching ready digests: {str(e)}")
-        return []
+        print(f"Error reading SES send quota: {str(e)}")
+        return DEFAULT_SEND_RATE
+
+def deliver_digests(digests, limiter, context=None, unclaimed=None):
+    """Send digests concurrently, paced by the rate limiter.
+    
+    Digests are claimed in batches before sending and only claimed digests
+    are sent; a digest whose claim keeps erroring counts as failed but stays
+    ready_to_send, so a rerun can still deliver it. Sends run on a thread
+    pool, with at most twice SEND_CONCURRENCY digests submitted at once.
+    Each digest's sent or failed transition is recorded as soon as its send
+    finishes and flushed in batches. With a Lambda context, claiming stops
+    SEND_DEADLINE_MARGIN_MS before the timeout and the rest are left for
+    the next run. Digests whose claim errored are appended to unclaimed
+    when it is given. Returns (sent_count, failed_count).
+    """
+    sent_count = 0
+    failed_count = 0
+    in_flight = {}
+    updater = DigestStatusUpdater(DIGESTS_TABLE)
+    
+    def settle(done):
+        nonlocal sent_count, failed_count
+        for future in done:
+            digest = in_flight.pop(future)
+            email = digest['email']
+            try:
+                future.result()
+                
+                # Record as sent in DynamoDB
+                updater.mark_sent(digest)
+                
+                sent_count += 1
+                metrics.increment('emails.sent')
+                print(f"✅ Sent digest to {email}")
+                
+            except Exception as e:
+                print(f"❌ Failed to send to {email}: {str(e)}")
+                updater.mark_failed(digest)
+                failed_count += 1
+                metrics.increment('emails.failed')
+    
+    try:
+        with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY, thread_name_prefix='ses-send') as pool:
+            try:
+                for batch in pickle_runtime.iter_batches(digests, STATUS_BATCH_SIZE):
+                    if context and context.get_remaining_time_in_millis() < SEND_DEADLINE_MARGIN_MS:
+                        print("Close to the timeout, leaving remaining digests for the next run")
+                        metrics.increment('delivery.stopped_early')
+                        break
+                    
+                    claimed, errored = updater.claim(batch)
+                    if unclaimed is not None:
+                        unclaimed.extend(errored)
+                    for digest in errored:
+                        print(f"❌ Failed to send to {digest['email']}: claim did not apply")
+                        failed_count += 1
+                        metrics.increment('emails.failed')
+                    
+                    for digest in claimed:
+                        if len(in_flight) >= SEND_CONCURRENCY * 2:
+                            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                            settle(done)
+                        
+                        future = pool.submit(
+                            send_email_with_backoff,
+                            digest['email'],
+                            digest['subject_line'],
+                            digest['html_content'],
+                            limiter
+                        )
+                        in_flight[future] = digest
+            finally:
+                # Sends already submitted are recorded even if reading digests failed
+                while in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    settle(done)
+    finally:
+        updater.flush()
+    
+    return sent_count, failed_count
 
+def send_email_with_backoff(to_email, subject, html_content, limiter):
+    """Send one email under the rate limiter, backing off on SES throttling"""
+    
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            message_id = send_email(to_email, subject, html_content)
+            limiter.on_success()
+            return message_id
+            
+        except Exception as e:
+            if not is_throttling_error(e) or attempt == SEND_MAX_RETRIES:
+                raise
+            
+            limiter.on_throttle()
+            metrics.increment('ses.retries')
+            delay = min(2 ** attempt * 0.1, 5) * random.uniform(0.5, 1.5)
+            print(f"SES throttled sending to {to_email}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+def is_throttling_error(error):
+    """True for SES 'Maximum sending rate exceeded' style errors"""
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code', '')
+    return code in ('Throttling', 'ThrottlingException')
+
+@metrics.timed('send_email')
 def send_email(to_email, subject, html_content):
     """Send email via Amazon SES"""
     
@@ -113,47 +531,4 @@ def send_email(to_email, subject, html_content):
         
     except Exception as e:
         print(f"SES error sending to {to_email}: {str(e)}")
-        raise e
-
-def mark_digest_as_sent(digest):
-    """Mark digest as sent in DynamoDB"""
-    try:
-        table = dynamodb.Table(DIGESTS_TABLE)
-        
-        table.update_item(
-            Key={
-                'email': digest['email'],
-            },
-            UpdateExpression='SET #status = :status, sent_at = :sent_at',
-            ExpressionAttributeNames={'#status': 'status'},
-            ExpressionAttributeValues={
-                ':status': 'sent',
-                ':sent_at': datetime.utcnow().isoformat()
-            }
-        )
-        
-    except Exception as e:
-        print(f"Error marking digest as sent: {str(e)}")
-        raise e
-
-def mark_digest_as_failed(digest):
-    """Mark digest as failed in DynamoDB"""
-    try:
-        table = dynamodb.Table(DIGESTS_TABLE)
-        
-        table.update_item(
-            Key={
-                'email': digest['email'],
-                'digest_date': digest['digest_date']
-            },
-            UpdateExpression='SET #status = :status, failed_at = :failed_at',
-            ExpressionAttributeNames={'#status': 'status'},
-            ExpressionAttributeValues={
-                ':status': 'failed',
-                ':failed_at': datetime.utcnow().isoformat()
-            }
-        )
-        
-    except Exception as e:
-        print(f"Error marking digest as failed: {str(e)}")
-        pass  # Don't fail the whole process
\ No newline at end of file
+        raise e
\ No newline at end of file
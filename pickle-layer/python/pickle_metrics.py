@@ -0,0 +1,173 @@
+"""Per-invocation stage timings and counters, emitted as CloudWatch EMF.
+
+Shared by all three Pickle Lambdas through the pickle-layer Lambda layer.
+Each function creates one module-level Metrics object, times its stages
+with metrics.timed / metrics.timer, counts events with metrics.increment
+and calls metrics.flush(context) once at the end of every invocation.
+
+flush prints one Embedded Metric Format document per stage (dimensions
+Service and Stage) plus one for the counters (dimension Service), so
+CloudWatch extracts the metrics straight from the log stream without any
+PutMetricData calls.
+"""
+
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+NAMESPACE = 'Pickle'
+
+# Latency histogram buckets grow by 2^(1/4), so a percentile read from the
+# buckets overstates the true value by at most ~19%, at constant memory per stage
+BUCKETS_PER_DOUBLING = 4
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram in milliseconds"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        bucket = math.ceil(math.log2(ms) * BUCKETS_PER_DOUBLING) if ms > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile sample"""
+        if not self.count:
+            return 0.0
+
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: -math.inf if b is None else b):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return 0.0 if bucket is None else min(self.max, 2 ** (bucket / BUCKETS_PER_DOUBLING))
+        return self.max
+
+    def to_dict(self):
+        """Bucket upper bounds (ms) to sample counts, for Logs Insights queries"""
+        return {
+            ('0' if bucket is None else f"{2 ** (bucket / BUCKETS_PER_DOUBLING):.3f}"): count
+            for bucket, count in sorted(self.buckets.items(), key=lambda kv: -math.inf if kv[0] is None else kv[0])
+        }
+
+class Metrics:
+    """Thread-safe collector for one Lambda's per-invocation metrics"""
+
+    def __init__(self, service, namespace=NAMESPACE):
+        self.service = service
+        self.namespace = namespace
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record_latency(self, stage, ms):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = LatencyHistogram()
+            histogram.record(ms)
+
+    def increment(self, name, value=1):
+        if not value:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, stage):
+        """Time a block as one sample of stage, including when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_latency(stage, (time.perf_counter() - started) * 1000)
+
+    def timed(self, stage):
+        """Decorator form of timer"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """Per-stage latency percentiles and counters collected so far"""
+        with self._lock:
+            return self._summarize(self._stages, self._counters)
+
+    def flush(self, context=None):
+        """Print this invocation's EMF documents and reset; returns the summary"""
+        with self._lock:
+            stages, self._stages = self._stages, {}
+            counters, self._counters = self._counters, {}
+
+        summary = self._summarize(stages, counters)
+        timestamp = int(time.time() * 1000)
+        request_id = getattr(context, 'aws_request_id', None)
+
+        for stage, stats in summary['stages'].items():
+            values = {
+                'Calls': (stats['count'], 'Count'),
+                'LatencyTotal': (stats['total_ms'], 'Milliseconds'),
+                'LatencyP50': (stats['p50_ms'], 'Milliseconds'),
+                'LatencyP90': (stats['p90_ms'], 'Milliseconds'),
+                'LatencyP99': (stats['p99_ms'], 'Milliseconds'),
+                'LatencyMax': (stats['max_ms'], 'Milliseconds')
+            }
+            print(json.dumps(self._document(
+                timestamp, {'Service': self.service, 'Stage': stage}, values,
+                {'requestId': request_id, 'histogram': stages[stage].to_dict()}
+            )))
+
+        if summary['counters']:
+            values = {name: (value, 'Count') for name, value in summary['counters'].items()}
+            print(json.dumps(self._document(
+                timestamp, {'Service': self.service}, values, {'requestId': request_id}
+            )))
+
+        return summary
+
+    @staticmethod
+    def _summarize(stages, counters):
+        return {
+            'stages': {
+                stage: {
+                    'count': histogram.count,
+                    'total_ms': round(histogram.total, 3),
+                    'p50_ms': round(histogram.percentile(50), 3),
+                    'p90_ms': round(histogram.percentile(90), 3),
+                    'p99_ms': round(histogram.percentile(99), 3),
+                    'max_ms': round(histogram.max, 3)
+                }
+                for stage, histogram in sorted(stages.items())
+            },
+            'counters': dict(sorted(counters.items()))
+        }
+
+    def _document(self, timestamp, dimensions, values, properties):
+        document = {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()]
+                }]
+            },
+            **dimensions,
+            **{name: value for name, (value, _) in values.items()}
+        }
+        document.update({key: value for key, value in properties.items() if value is not None})
+        return document
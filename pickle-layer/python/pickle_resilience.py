@@ -0,0 +1,275 @@
+"""Rate limiting, retries and circuit breaking for the services Pickle calls.
+
+Shared by the Pickle Lambdas through the pickle-layer Lambda layer. Each
+upstream service gets one module-level ServiceGuard per container, and
+every request to it goes through guard.call(func, *args):
+
+1. While the circuit is open the call fails at once with CircuitOpenError,
+   so a provider that is down or out of quota is not hammered and callers
+   go straight to their fallback.
+2. An AdaptiveRateLimiter token bucket paces calls from every thread. It
+   starts at the configured ceiling, halves on each throttle and climbs
+   back by 5% of the ceiling per success, so it settles just under the
+   rate the provider accepts instead of spending calls on 429s.
+3. Throttles and transient errors (5xx, timeouts, dropped connections) are
+   retried with full-jitter exponential backoff. A Retry-After hint pauses
+   the whole bucket for that long; a hint longer than max_backoff opens the
+   circuit for that long instead of retrying.
+4. After failure_threshold consecutive calls fail despite retries, the
+   circuit opens for reset_seconds, then lets a single probe call through.
+
+Outcomes are counted on a pickle_metrics.Metrics as '<service>.throttles',
+'<service>.retries', '<service>.shed' and '<service>.circuit_opened', and
+time spent waiting for the rate limiter is recorded as the
+'<service>_rate_limit_wait' stage.
+"""
+
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Error codes from boto3 ClientError responses. Bedrock stream events use
+# camel case ('throttlingException'), so codes are compared capitalized.
+THROTTLE_CODES = {
+    'Throttling', 'ThrottlingException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'ProvisionedThroughputExceededException'
+}
+TRANSIENT_CODES = {
+    'ServiceUnavailable', 'ServiceUnavailableException', 'InternalFailure',
+    'InternalServerException', 'ModelNotReadyException', 'ModelTimeoutException',
+    'RequestTimeout'
+}
+
+class RetryableError(Exception):
+    """Raised by a guarded call for a response worth retrying, e.g. HTTP 429 or 5xx"""
+
+    def __init__(self, message, retry_after=None, throttled=False):
+        super().__init__(message)
+        self.retry_after = parse_retry_after(retry_after)
+        self.throttled = throttled
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit is open"""
+
+class AdaptiveRateLimiter:
+    """Token bucket that starts at a service's max rate and adapts to throttling.
+
+    A throttle halves the rate (down to min_rate); each success adds back a
+    small step until the ceiling is reached again. pause() holds every
+    caller back, e.g. for a Retry-After.
+    """
+
+    def __init__(self, max_rate, min_rate=0.5):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.capacity = max(1.0, max_rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available; returns the seconds waited"""
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                self._refill()
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait_seconds = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return now - started
+                else:
+                    wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def set_max_rate(self, max_rate):
+        """Change the ceiling, e.g. to a shard's share of a provider-wide limit"""
+        with self._lock:
+            self.max_rate = max_rate
+            self.min_rate = min(self.min_rate, max_rate)
+            self.rate = min(self.rate, max_rate)
+            self.capacity = max(1.0, max_rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe"""
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_until = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go out now"""
+        with self._lock:
+            if self.opened_until is None:
+                return True
+            if time.monotonic() < self.opened_until or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_until = None
+            self.probing = False
+
+    def record_failure(self):
+        """Count a failed call; returns True if this opened the circuit"""
+        with self._lock:
+            self.failures += 1
+            if not self.probing and self.failures < self.failure_threshold:
+                return False
+        self.open(self.reset_seconds)
+        return True
+
+    def open(self, seconds):
+        with self._lock:
+            self.opened_until = time.monotonic() + seconds
+            self.probing = False
+
+class ServiceGuard:
+    """Rate limiter, retry policy and circuit breaker for one upstream service"""
+
+    def __init__(self, name, max_rate, metrics=None, max_attempts=4, base_backoff=0.25,
+                 max_backoff=20.0, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.metrics = metrics
+        self.max_attempts = max(1, max_attempts)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.limiter = AdaptiveRateLimiter(max_rate)
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+
+    def call(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) under the guard and return its result.
+
+        Errors that are not throttles or transient are raised at once.
+        """
+        if not self.breaker.allow():
+            self._increment('shed')
+            raise CircuitOpenError(f"{self.name} circuit is open, request shed")
+
+        for attempt in range(self.max_attempts):
+            waited = self.limiter.acquire()
+            if self.metrics:
+                self.metrics.record_latency(f"{self.name}_rate_limit_wait", waited * 1000)
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as error:
+                kind, retry_after = classify_error(error)
+                if kind is None:
+                    # The service answered; the request itself was bad
+                    self.breaker.record_success()
+                    raise
+
+                if kind == 'throttle':
+                    self._increment('throttles')
+                    self.limiter.on_throttle()
+
+                if retry_after is not None and retry_after > self.max_backoff:
+                    print(f"{self.name} asked to retry after {retry_after:.0f}s, opening circuit")
+                    self.breaker.open(retry_after)
+                    self._increment('circuit_opened')
+                    raise
+
+                if attempt == self.max_attempts - 1:
+                    if self.breaker.record_failure():
+                        print(f"{self.name} failing repeatedly, opening circuit for {self.breaker.reset_seconds:g}s")
+                        self._increment('circuit_opened')
+                    raise
+
+                delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+                if retry_after is not None:
+                    self.limiter.pause(retry_after)
+                    delay = max(delay, retry_after)
+                self._increment('retries')
+                print(f"{self.name} {kind} ({str(error)}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+            else:
+                self.limiter.on_success()
+                self.breaker.record_success()
+                return result
+
+    def _increment(self, counter):
+        if self.metrics:
+            self.metrics.increment(f"{self.name}.{counter}")
+
+def classify_error(error):
+    """Return (kind, retry_after seconds) for an exception.
+
+    kind is 'throttle', 'error' for a transient failure, or None if
+    retrying would not help.
+    """
+    if isinstance(error, RetryableError):
+        return ('throttle' if error.throttled else 'error'), error.retry_after
+
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code') or ''
+        code = code[:1].upper() + code[1:]
+        metadata = response.get('ResponseMetadata', {})
+        retry_after = parse_retry_after(metadata.get('HTTPHeaders', {}).get('retry-after'))
+        if code in THROTTLE_CODES or metadata.get('HTTPStatusCode') == 429:
+            return 'throttle', retry_after
+        if code in TRANSIENT_CODES or metadata.get('HTTPStatusCode', 0) >= 500:
+            return 'error', retry_after
+        return None, None
+
+    if is_transport_error(error):
+        return 'error', None
+    return None, None
+
+def is_transport_error(error):
+    """Timeouts and connection failures from urllib3 or botocore"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if type(error).__module__.startswith('urllib3.'):
+        return True
+    # botocore's EndpointConnectionError, ReadTimeoutError etc. share this base
+    return any(cls.__name__ == 'HTTPClientError' for cls in type(error).__mro__)
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After value (delta seconds or HTTP date), or None"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
@@ -0,0 +1,143 @@
+"""Lazily created AWS clients and a pooled HTTP client for the Pickle Lambdas.
+
+Shared by all three functions through the pickle-layer Lambda layer.
+Importing this module does not import boto3: client() and resource()
+return proxies that build the real client on first attribute access, so an
+invocation only pays for the clients it actually uses. Proxies are cached,
+so every caller in a container shares one client per service and settings.
+
+News API calls go through http_pool(), a urllib3 PoolManager. urllib3 is
+already loaded by botocore, so this replaces the requests import for free.
+iter_batches() splits a stream of subscriptions or digests into fixed-size batches.
+
+Cold-start cost is reported through report(metrics): the first invocation
+counts a cold start, and the time spent creating each client is recorded
+as an 'init.<name>' stage. For a per-module import breakdown, set
+PYTHONPROFILEIMPORTTIME=1 on the function and read the import log.
+"""
+
+import json
+import threading
+import time
+
+_lock = threading.RLock()
+_proxies = {}
+_session = None
+_timings = []
+_cold_start = True
+
+class LazyClient:
+    """Proxy that creates a boto3 client or resource on first use"""
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._target = None
+
+    def __getattr__(self, attribute):
+        return getattr(self.resolve(), attribute)
+
+    def resolve(self):
+        """Return the real client, creating it if needed"""
+        if self._target is None:
+            # boto3 sessions are not thread-safe, so clients are built one at a time
+            with _lock:
+                if self._target is None:
+                    started = time.perf_counter()
+                    self._target = self._factory()
+                    record_timing(f"init.{self._name}", (time.perf_counter() - started) * 1000)
+        return self._target
+
+    def __repr__(self):
+        state = 'created' if self._target is not None else 'not created'
+        return f"<LazyClient {self._name} ({state})>"
+
+def client(service_name, region_name=None, **config_options):
+    """Shared lazy boto3 client; config_options are botocore Config arguments"""
+    def factory():
+        config = None
+        if config_options:
+            from botocore.config import Config
+            config = Config(**config_options)
+        return shared_session().client(service_name, region_name=region_name, config=config)
+
+    return _proxy(('client', service_name, region_name, json.dumps(config_options, sort_keys=True)),
+                  f"client.{service_name}", factory)
+
+def resource(service_name, region_name=None):
+    """Shared lazy boto3 resource"""
+    def factory():
+        return shared_session().resource(service_name, region_name=region_name)
+
+    return _proxy(('resource', service_name, region_name), f"resource.{service_name}", factory)
+
+def dynamodb_deserializer():
+    """Shared lazy boto3 TypeDeserializer for DynamoDB Streams images"""
+    def factory():
+        from boto3.dynamodb.types import TypeDeserializer
+        return TypeDeserializer()
+
+    return _proxy(('deserializer', 'dynamodb'), 'dynamodb_deserializer', factory)
+
+def shared_session():
+    """The container's boto3 session, created on first use"""
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3
+            _session = boto3.session.Session()
+        return _session
+
+def new_resource(service_name, region_name=None):
+    """A new, unshared boto3 resource for use on one worker thread.
+
+    Resources are not thread-safe, but building one from the shared session
+    under the lock is, and reuses the service models it has already loaded.
+    """
+    with _lock:
+        return shared_session().resource(service_name, region_name=region_name)
+
+def http_pool(maxsize=10):
+    """Shared keep-alive urllib3 PoolManager allowing maxsize connections per host.
+
+    Retries and redirects are left to the caller, as with requests.get.
+    """
+    def factory():
+        import urllib3
+        return urllib3.PoolManager(maxsize=maxsize, retries=False)
+
+    return _proxy(('http', maxsize), 'http_pool', factory)
+
+def iter_batches(items, batch_size):
+    """Group an iterable into lists of at most batch_size items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def record_timing(stage, ms):
+    with _lock:
+        _timings.append((stage, ms))
+
+def report(metrics):
+    """Send cold-start and client creation timings to a pickle_metrics.Metrics"""
+    global _cold_start
+    with _lock:
+        timings, _timings[:] = list(_timings), []
+        cold_start, _cold_start = _cold_start, False
+
+    if cold_start:
+        metrics.increment('cold_starts')
+    for stage, ms in timings:
+        metrics.record_latency(stage, ms)
+
+def _proxy(key, name, factory):
+    with _lock:
+        proxy = _proxies.get(key)
+        if proxy is None:
+            proxy = _proxies[key] = LazyClient(name, factory)
+        return proxy
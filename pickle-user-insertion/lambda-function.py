@@ -1,14 +1,27 @@
 import json
-import boto3
 import time
 from datetime import datetime
+import pickle_runtime
+from pickle_metrics import Metrics
 
 REGION = "us-east-2"
-dynamodb = boto3.resource('dynamodb', region_name=REGION)
+
+# Low-level client: skips building the resource model on this latency-sensitive path
+dynamodb_client = pickle_runtime.client('dynamodb', region_name=REGION)
+
+# Stage timings and counters, emitted as CloudWatch EMF after each invocation
+metrics = Metrics('pickle-user-insertion')
 
 SUBSCRIPTIONS_TABLE = 'pickle-user-subscriptions'
 
 def lambda_handler(event, context):
+    try:
+        return handle_request(event)
+    finally:
+        pickle_runtime.report(metrics)
+        metrics.flush(context)
+
+def handle_request(event):
 
     print(f"Received event: {json.dumps(event)}")
     
@@ -58,25 +71,24 @@ def lambda_handler(event, context):
             'body': json.dumps({'error': str(e)})
         }
 
+@metrics.timed('create_subscription')
 def create_subscription(email, topic):
     """Create subscription with email and topic, and store in database."""
     try:
-        table = dynamodb.Table(SUBSCRIPTIONS_TABLE)
-        
         # Calculate TTL (2 days from now)
         ttl = int(time.time()) + (2 * 24 * 60 * 60)
         
         item = {
-            'email': email,
-            'topic': topic,
-            'created_at': datetime.utcnow().isoformat(),
-            'expires_at': datetime.fromtimestamp(ttl).isoformat(),
-            'ttl': ttl,
-            'status': 'active',
-            'last_processed': datetime.utcnow().isoformat()
+            'email': {'S': email},
+            'topic': {'S': topic},
+            'created_at': {'S': datetime.utcnow().isoformat()},
+            'expires_at': {'S': datetime.fromtimestamp(ttl).isoformat()},
+            'ttl': {'N': str(ttl)},
+            'status': {'S': 'active'},
+            'last_processed': {'S': datetime.utcnow().isoformat()}
         }
         
-        table.put_item(Item=item)
+        dynamodb_client.put_item(TableName=SUBSCRIPTIONS_TABLE, Item=item)
         print(f"Successfully created subscription for {email}")
         
     except Exception as e:
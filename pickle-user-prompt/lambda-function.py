@@ -1,81 +1,1101 @@
 import json
-import boto3
-import requests
 import os
 from datetime import datetime, timedelta
 import random
 import urllib.parse
 import re
+import queue
+import threading
+import heapq
+import math
+import hashlib
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import pickle_runtime
+from pickle_metrics import Metrics
+from pickle_resilience import RetryableError, ServiceGuard
 
 # Configuration
 REGION = "us-east-2"
 NEWS_API_KEY = os.environ['NEWS_API_KEY']
+NEWS_API_URL = os.environ.get('NEWS_API_URL', 'https://newsapi.org/v2/everything')
 MODEL_ID = "meta.llama3-3-70b-instruct-v1:0"
 MAX_TOKENS = 1024
 TEMPERATURE = 0.3
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb', region_name=REGION)
-bedrock = boto3.session.Session().client(
-    service_name="bedrock-runtime",
+# Opt-in: stream generations and stop reading once the useful output is complete
+LLM_STREAMING = os.environ.get('LLM_STREAMING', 'false') == 'true'
+
+# Request ceilings (per second, split across shards) for News API and Bedrock.
+# Calls adapt below them on throttling, retry throttles and transient errors
+# with backoff, and are shed while a service keeps failing.
+NEWS_API_MAX_RATE = float(os.environ.get('NEWS_API_MAX_RATE', '10'))
+BEDROCK_MAX_RATE = float(os.environ.get('BEDROCK_MAX_RATE', '10'))
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '4'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', '30'))
+
+# Parallel scan settings for the subscriptions table
+SCAN_SEGMENTS = int(os.environ.get('SCAN_SEGMENTS', '4'))
+SCAN_PAGE_LIMIT = int(os.environ.get('SCAN_PAGE_LIMIT', '500'))
+SCAN_QUEUE_PAGES = 2  # Pages buffered per segment before scanners block
+
+# Topic -> keywords cache settings
+KEYWORD_CACHE_SIZE = int(os.environ.get('KEYWORD_CACHE_SIZE', '1024'))
+KEYWORD_CACHE_TTL_DAYS = int(os.environ.get('KEYWORD_CACHE_TTL_DAYS', '3'))
+
+# Topics per batched keyword-extraction prompt (1 disables batching)
+KEYWORD_BATCH_SIZE = int(os.environ.get('KEYWORD_BATCH_SIZE', '20'))
+MAX_BATCH_GEN_LEN = 2048  # Bedrock's max_gen_len ceiling for Llama models
+
+# Topic clustering: 'hashing' (local), 'bedrock' (Titan embeddings) or 'off'
+TOPIC_CLUSTERING = os.environ.get('TOPIC_CLUSTERING', 'hashing')
+TOPIC_SIMILARITY_THRESHOLD = float(os.environ.get('TOPIC_SIMILARITY_THRESHOLD', '0.85'))
+TOPIC_HASH_DIM = 1024
+TOPIC_LSH_BANDS = 20  # Signature bands; a topic is only compared within shared buckets
+TOPIC_LSH_BAND_BITS = 12
+TOPIC_CLUSTER_LIMIT = int(os.environ.get('TOPIC_CLUSTER_LIMIT', '5000'))  # Up to 20 MB of hashed vectors
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"
+EMBEDDING_DIM = 256
+TOPIC_STOPWORDS = {
+    'a', 'about', 'an', 'and', 'any', 'for', 'in', 'informed', 'keep', 'latest',
+    'me', 'news', 'of', 'on', 'the', 'to', 'updates', 'with'
+}
+
+# Generated digest cache settings
+DIGEST_CACHE_SIZE = int(os.environ.get('DIGEST_CACHE_SIZE', '512'))
+
+# Digest prompt budget, in estimated tokens (~4 characters each)
+DIGEST_ARTICLE_TOKEN_BUDGET = int(os.environ.get('DIGEST_ARTICLE_TOKEN_BUDGET', '1200'))
+DIGEST_BASE_GEN_TOKENS = 256  # Subject, welcome, headings and sign-off
+DIGEST_GEN_TOKENS_PER_ARTICLE = 72  # One or two bullets per article kept
+# (description, content preview) characters kept by article rank; later ranks keep the title only
+DIGEST_FIELD_LIMITS = [(320, 200)] * 3 + [(200, 0)] * 3 + [(120, 0)] * 4
+
+# Users whose keywords are generated and fetched together
+USER_BATCH_SIZE = int(os.environ.get('USER_BATCH_SIZE', '100'))
+SEARCH_KEYWORD_LIMIT = 5  # Keywords per user sent to News API
+TOP_ARTICLE_COUNT = 10  # Articles per digest sent to the LLM
+NEWS_LOOKBACK_DAYS = 7
+NEWS_PAGE_SIZE = 30  # Newest articles returned per News API request
+NEWS_FETCH_CONCURRENCY = int(os.environ.get('NEWS_FETCH_CONCURRENCY', '5'))
+
+# Incremental fetching: each subscriber only gets articles published since
+# their last digest (less an overlap for News API indexing lag), and each
+# keyword's cached articles are topped up from its last fetch. URLs already
+# sent in a subscriber's recent digests are never picked again.
+NEWS_WATERMARK_OVERLAP_HOURS = int(os.environ.get('NEWS_WATERMARK_OVERLAP_HOURS', '6'))
+ARTICLE_REFRESH_MINUTES = int(os.environ.get('ARTICLE_REFRESH_MINUTES', '60'))
+RECENT_URL_LIMIT = int(os.environ.get('RECENT_URL_LIMIT', '50'))
+
+# 'keyword' counts keyword matches in each user's own fetches; 'bm25' ranks each
+# user's keywords against every article fetched today (BM25F, fields 3/2/1)
+RANKING_MODE = os.environ.get('RANKING_MODE', 'keyword')
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_CANDIDATE_FACTOR = 4  # Candidates per digest slot kept for near-duplicate collapsing
+
+# Syndicated copies of a story (SimHash of title + description) collapse before ranking
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_MAX_DISTANCE', '7'))  # Of 64 bits
+FINGERPRINT_CACHE_SIZE = 20000
+
+# 'sequential' processes one user at a time; 'pipelined' keeps many in flight
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'sequential')
+USER_CONCURRENCY = int(os.environ.get('USER_CONCURRENCY', '50'))
+BEDROCK_CONCURRENCY = int(os.environ.get('BEDROCK_CONCURRENCY', '8'))
+DYNAMODB_CONCURRENCY = int(os.environ.get('DYNAMODB_CONCURRENCY', '10'))
+
+# Orchestrator/worker fan-out: each shard is processed by its own worker
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '8'))
+SHARD_DISPATCH = os.environ.get('SHARD_DISPATCH', 'lambda')  # 'lambda' or 'local'
+WORKER_FUNCTION_NAME = os.environ.get('WORKER_FUNCTION_NAME')  # Defaults to this function
+
+# Checkpoint/resume when a run approaches the Lambda timeout
+CHECKPOINT_MARGIN_MS = int(os.environ.get('CHECKPOINT_MARGIN_MS', '90000'))
+RESUME_SELF_INVOKE = os.environ.get('RESUME_SELF_INVOKE', 'true') == 'true'
+
+# Digests are buffered and written in batches; full HTML logging is opt-in
+DIGEST_FLUSH_SIZE = int(os.environ.get('DIGEST_FLUSH_SIZE', '100'))
+LOG_DIGEST_HTML = os.environ.get('LOG_DIGEST_HTML', 'false') == 'true'
+
+# Stage timings and counters, emitted as CloudWatch EMF after each invocation
+metrics = Metrics('pickle-user-prompt')
+
+# AWS clients are created on first use, so each invocation only pays for what it calls.
+# DynamoDB resources are per thread (see thread_dynamodb); the low-level client is shared.
+thread_state = threading.local()
+dynamodb_client = pickle_runtime.client('dynamodb', region_name=REGION)
+
+# Retries are left to bedrock_guard, so throttles also slow the shared rate
+bedrock = pickle_runtime.client('bedrock-runtime', region_name=REGION, retries={'max_attempts': 0})
+
+# Workers can run up to the 15-minute Lambda limit
+lambda_client = pickle_runtime.client(
+    'lambda',
     region_name=REGION,
+    read_timeout=900,
+    retries={'max_attempts': 0}
+)
+
+# Keep-alive connection pool shared by all News API calls
+news_http = pickle_runtime.http_pool(maxsize=NEWS_FETCH_CONCURRENCY)
+
+# One rate limiter, retry policy and circuit breaker per service, shared by every thread
+news_guard = ServiceGuard(
+    'news_api', NEWS_API_MAX_RATE, metrics, max_attempts=RETRY_MAX_ATTEMPTS,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS
+)
+bedrock_guard = ServiceGuard(
+    'bedrock', BEDROCK_MAX_RATE, metrics, max_attempts=RETRY_MAX_ATTEMPTS,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS
+)
+# Titan embeddings have their own Bedrock quota, so their throttles must not slow the LLM
+embedding_guard = ServiceGuard(
+    'bedrock_embeddings', BEDROCK_MAX_RATE, metrics, max_attempts=RETRY_MAX_ATTEMPTS,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS
+)
+
+# Shared pool so the concurrency limit holds across users and prefetches
+news_fetch_pool = ThreadPoolExecutor(
+    max_workers=NEWS_FETCH_CONCURRENCY,
+    thread_name_prefix='news-fetch'
+)
+
+# Pipelined stages run here rather than on each event loop's default executor,
+# so worker threads (and their DynamoDB resources) outlive a single batch
+pipeline_pool = ThreadPoolExecutor(
+    max_workers=BEDROCK_CONCURRENCY + NEWS_FETCH_CONCURRENCY + DYNAMODB_CONCURRENCY,
+    thread_name_prefix='pipeline'
 )
 
 SUBSCRIPTIONS_TABLE = 'pickle-user-subscriptions'
 DIGESTS_TABLE = 'pickle-user-digests'
+KEYWORD_CACHE_TABLE = 'pickle-keyword-cache'
+CHECKPOINTS_TABLE = 'pickle-run-checkpoints'
 
-def lambda_handler(event, context):
-    print(f"Starting daily digest generation at {datetime.utcnow()}")
+class LRUCache:
+    """Thread-safe in-process LRU cache"""
     
-    try:
-        # Get all active subscriptions
-        active_users = get_active_subscriptions()
-        print(f"Found {len(active_users)} active subscriptions")
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+    
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._items)
+
+class TopicKeywordCache:
+    """Two-layer topic -> keywords cache: in-process LRU backed by DynamoDB.
+    
+    The LRU survives warm invocations of the same container; the DynamoDB
+    layer (expired through its 'ttl' attribute) is shared across containers
+    and days, so popular topics only reach Bedrock once per TTL window.
+    """
+    
+    def __init__(self, table_name, max_size, ttl_days):
+        self.table_name = table_name
+        self.ttl_days = ttl_days
+        self.memory = LRUCache(max_size)
+        self.stats = {'memory_hits': 0, 'dynamo_hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+    
+    def get(self, topic):
+        """Return cached keywords for a topic, or None on a miss"""
+        key = normalize_topic(topic)
         
-        if not active_users:
-            return {
-                'statusCode': 200,
-                'body': json.dumps({'message': 'No active subscriptions found'})
-            }
+        keywords = self.memory.get(key)
+        if keywords is not None:
+            self._count('memory_hits')
+            return keywords
+        
+        try:
+            table = thread_dynamodb().Table(self.table_name)
+            item = table.get_item(Key={'topic_key': key}).get('Item')
+            
+            # DynamoDB deletes expired items lazily, so check the TTL here too
+            if item and int(item.get('ttl', 0)) > int(time.time()):
+                keywords = list(item['keywords'])
+                self.memory.put(key, keywords)
+                self._count('dynamo_hits')
+                return keywords
+                
+        except Exception as e:
+            print(f"Keyword cache read failed for '{key}': {str(e)}")
+        
+        self._count('misses')
+        return None
+    
+    def put(self, topic, keywords):
+        """Store keywords for a topic in both layers"""
+        key = normalize_topic(topic)
+        self.memory.put(key, keywords)
         
-        processed_users = 0
+        try:
+            table = thread_dynamodb().Table(self.table_name)
+            table.put_item(Item={
+                'topic_key': key,
+                'keywords': keywords,
+                'cached_at': datetime.utcnow().isoformat(),
+                'ttl': int((datetime.utcnow() + timedelta(days=self.ttl_days)).timestamp())
+            })
+        except Exception as e:
+            print(f"Keyword cache write failed for '{key}': {str(e)}")
+    
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = sum(stats.values())
+        hits = stats['memory_hits'] + stats['dynamo_hits']
+        stats['hit_rate'] = round(hits / lookups, 3) if lookups else 0.0
+        return stats
+    
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+        metrics.increment(f"keyword_cache.{stat}")
+
+def normalize_topic(topic):
+    """Normalize a free-text topic so equivalent spellings share cache entries"""
+    words = re.sub(r'[^\w\s]', ' ', topic.lower()).split()
+    return ' '.join(words)
+
+class ArticleFetchCache:
+    """Shared cache of News API results with a fetch watermark per keyword.
+    
+    Each keyword keeps its newest articles (newest first), the oldest
+    publish time they are complete from (covered_from) and when News API was
+    last asked (fetched_through). A request for articles since some time is
+    served by filtering the entry; only the missing part of the window is
+    ever fetched: a gap before covered_from, or new articles published since
+    fetched_through once the entry is ARTICLE_REFRESH_MINUTES old. Every
+    user's ranking step reads from the same entries, so a keyword is fetched
+    at most once per window no matter how many subscribers share it.
+    """
+    
+    def __init__(self):
+        self._entries = {}
+        self._pending = {}
+        self._floor = None
+        self.stats = {'hits': 0, 'misses': 0, 'errors': 0}
+        self._lock = threading.Lock()
+    
+    def store(self, keyword, since, until, articles):
+        """Merge articles fetched for the window [since, until] into the keyword's entry"""
+        fetched_at = time.monotonic()
         
-        for user in active_users:
-            email = user['email']
-            topic = user['topic']
+        with self._lock:
+            floor = news_lookback_floor()
+            self._roll_window(floor)
+            key = normalize_keyword(keyword)
+            entry = self._entries.get(key)
+            
+            if entry is None:
+                entry = self._entries[key] = {
+                    'articles': [], 'covered_from': since, 'fetched_through': since, 'fetched_at': -math.inf
+                }
+            if until is None:
+                # A forward fetch moves the keyword's watermark up to now
+                entry['fetched_through'] = news_timestamp(datetime.utcnow())
+                entry['fetched_at'] = fetched_at
+            else:
+                entry['covered_from'] = min(entry['covered_from'], since)
             
-            print(f"Generating digest for {email}: {topic}")
+            merged = {article.get('url'): article for article in entry['articles']}
+            for article in articles:
+                if article.get('url') and (article.get('publishedAt') or '') >= floor:
+                    merged.setdefault(article['url'], article)
+            ordered = sorted(merged.values(), key=lambda article: article.get('publishedAt') or '', reverse=True)
+            
+            # A full page means News API had more than it returned, and the
+            # newest page is the same for any earlier since, so the entry
+            # answers every window back to the lookback floor
+            if len(articles) >= NEWS_PAGE_SIZE or len(ordered) > NEWS_PAGE_SIZE:
+                entry['covered_from'] = floor
+            entry['articles'] = ordered[:NEWS_PAGE_SIZE]
+        
+        if RANKING_MODE == 'bm25':
+            article_corpus.add(articles, floor[:10])
+    
+    def get_or_fetch(self, keyword, since=None):
+        """Return a keyword's articles published since a News API timestamp.
+        
+        Only the part of the window not yet cached is requested. Concurrent
+        misses for the same keyword share a single in-flight request.
+        """
+        key = normalize_keyword(keyword)
+        fetched = False
+        refreshed = False
+        
+        while True:
+            with self._lock:
+                floor = news_lookback_floor()
+                self._roll_window(floor)
+                since = max(since or floor, floor)
+                entry = self._entries.get(key)
+                window = self._missing_window(entry, since, refresh=not refreshed)
+                
+                if window is None:
+                    if not fetched:
+                        self.stats['hits'] += 1
+                        metrics.increment('article_cache.hits')
+                    return [article for article in entry['articles'] if (article.get('publishedAt') or '') >= since]
+                
+                pending = self._pending.get(key)
+                owner = pending is None
+                if owner:
+                    pending = self._pending[key] = Future()
+                    self.stats['misses'] += 1
+                    metrics.increment('article_cache.misses')
+            
+            if not owner:
+                # Another thread is fetching this keyword; check again once it lands
+                pending.result()
+                refreshed = True
+                continue
             
             try:
-                # Step 1: Generate keywords using LLM
-                keywords = generate_keywords_with_llm(topic)
-                print(f"Generated keywords: {keywords}")
+                articles = call_news_api_everything(keyword, window)
+                self.store(keyword, window[0], window[1], articles)
+                fetched = refreshed = True
+                pending.set_result(None)
+            except Exception as e:
+                # Failed fetches are not cached so later users can retry
+                with self._lock:
+                    self.stats['errors'] += 1
+                metrics.increment('article_cache.errors')
+                pending.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+    
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['keywords'] = len(self._entries)
+        return stats
+    
+    @staticmethod
+    def _missing_window(entry, since, refresh=True):
+        """The (since, until) window to fetch next, or None if the entry covers since.
+        
+        until is None for a fetch up to now. An entry that was just fetched
+        or waited on is not refreshed again in the same call.
+        """
+        if entry is None:
+            return since, None
+        if since < entry['covered_from']:
+            return since, entry['covered_from']
+        if refresh and time.monotonic() - entry['fetched_at'] > ARTICLE_REFRESH_MINUTES * 60:
+            # Overlap the previous fetch so late-indexed articles are not missed
+            resume_from = datetime.strptime(entry['fetched_through'], NEWS_TIMESTAMP_FORMAT)
+            return news_timestamp(resume_from - timedelta(hours=NEWS_WATERMARK_OVERLAP_HOURS)), None
+        return None
+    
+    def _roll_window(self, floor):
+        """Drop articles older than the lookback, and keywords no longer refreshed"""
+        if floor == self._floor:
+            return
+        self._floor = floor
+        for key, entry in list(self._entries.items()):
+            if entry.get('fetched_through', '') < floor:
+                del self._entries[key]
+                continue
+            entry['articles'] = [article for article in entry['articles'] if (article.get('publishedAt') or '') >= floor]
+            entry['covered_from'] = max(entry['covered_from'], floor)
+
+class ArticleCorpus:
+    """Same-day corpus of every fetched article with a BM25F inverted index.
+    
+    Each article is indexed once (by URL) with per-field term counts for
+    title, description and content, weighted 3/2/1 like the keyword scorer.
+    A term's scores over the whole corpus are computed on first use and
+    shared by every query containing it until new articles arrive, so a
+    batch of users sharing keywords is ranked in one pass. The corpus is
+    cleared when the day rolls over.
+    """
+    
+    FIELDS = (('title', 3.0), ('description', 2.0), ('content', 1.0))
+    
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._day = None
+        self._lock = threading.Lock()
+        self._reset()
+    
+    def add(self, articles, day):
+        """Index articles not already in the corpus"""
+        with self._lock:
+            if day != self._day:
+                self._reset()
+                self._day = day
+            
+            added = 0
+            for article in articles:
+                url = article.get('url')
+                if not url or url in self._doc_ids:
+                    continue
                 
-                # Step 2: Fetch articles using keywords
-                articles = fetch_news_articles(keywords)
-                print(f"Found {len(articles)} articles")
+                doc_id = len(self._articles)
+                self._doc_ids[url] = doc_id
+                self._articles.append(article)
                 
-                # Step 3: Generate final digest content
-                digest_content = generate_digest_content(topic, articles)
+                field_terms = [Counter(corpus_terms(article.get(field))) for field, _ in self.FIELDS]
+                lengths = tuple(sum(terms.values()) for terms in field_terms)
+                self._lengths.append(lengths)
+                for i, length in enumerate(lengths):
+                    self._length_totals[i] += length
                 
-                # Step 4: Store ready-to-send digest
-                store_digest(email, topic, digest_content, len(articles))
+                for term in set().union(*field_terms):
+                    self._postings.setdefault(term, []).append(
+                        (doc_id,) + tuple(terms.get(term, 0) for terms in field_terms)
+                    )
+                added += 1
+            
+            if added:
+                self._term_scores.clear()
+    
+    def search(self, keywords, limit, accept=None):
+        """Return up to limit (article, score) pairs for the keywords, best first.
+        
+        accept, if given, is called with each matching article and can
+        exclude it (e.g. one outside the user's fetch window).
+        """
+        terms = list(dict.fromkeys(
+            term for keyword in keywords for term in corpus_terms(keyword)
+            if term not in TOPIC_STOPWORDS
+        ))
+        
+        with self._lock:
+            totals = {}
+            for term in terms:
+                for doc_id, score in self._scores_for(term).items():
+                    totals[doc_id] = totals.get(doc_id, 0.0) + score
+            if accept:
+                totals = {doc_id: score for doc_id, score in totals.items() if accept(self._articles[doc_id])}
+            
+            # Ties go to the more recent article, as in the keyword scorer
+            best = heapq.nlargest(
+                limit, totals.items(),
+                key=lambda item: (item[1], self._articles[item[0]].get('publishedAt') or '')
+            )
+            return [(self._articles[doc_id], score) for doc_id, score in best]
+    
+    def summary(self):
+        with self._lock:
+            return {'articles': len(self._articles), 'terms': len(self._postings)}
+    
+    def _scores_for(self, term):
+        """BM25F contribution of one term to every document containing it"""
+        scores = self._term_scores.get(term)
+        if scores is not None:
+            return scores
+        
+        postings = self._postings.get(term, ())
+        doc_count = len(self._articles)
+        idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+        average_lengths = [total / doc_count if doc_count else 0 for total in self._length_totals]
+        
+        scores = {}
+        for doc_id, *field_counts in postings:
+            lengths = self._lengths[doc_id]
+            weighted_tf = 0.0
+            for (_, weight), count, length, average in zip(self.FIELDS, field_counts, lengths, average_lengths):
+                if count:
+                    weighted_tf += weight * count / (1 - self.b + self.b * length / (average or 1))
+            scores[doc_id] = idf * weighted_tf / (self.k1 + weighted_tf)
+        
+        self._term_scores[term] = scores
+        return scores
+    
+    def _reset(self):
+        self._articles = []  # doc id -> article
+        self._doc_ids = {}  # url -> doc id
+        self._lengths = []  # doc id -> term count per field
+        self._length_totals = [0] * len(self.FIELDS)
+        self._postings = {}  # term -> [(doc id, count per field)]
+        self._term_scores = {}
+
+def corpus_terms(text):
+    """Lowercased word tokens, without NewsAPI's '[+N chars]' marker"""
+    if not text:
+        return []
+    return re.findall(r'\w+', NEWSAPI_TRUNCATION_MARKER.sub('', text).lower())
+
+class DigestCache:
+    """Same-day cache of generated digests keyed by topic and article set.
+    
+    Users who share a topic usually end up with the same top articles, so
+    the key is a hash of the date, the normalized topic and the ordered
+    article URLs. Least recently used digests are evicted first.
+    """
+    
+    def __init__(self, max_size):
+        self.memory = LRUCache(max_size)
+        self.stats = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+    
+    def get(self, topic, articles):
+        """Return a cached digest, or None on a miss"""
+        digest_content = self.memory.get(self._key(topic, articles))
+        stat = 'hits' if digest_content is not None else 'misses'
+        with self._lock:
+            self.stats[stat] += 1
+        metrics.increment(f"digest_cache.{stat}")
+        return digest_content
+    
+    def put(self, topic, articles, digest_content):
+        self.memory.put(self._key(topic, articles), digest_content)
+    
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        total = stats['hits'] + stats['misses']
+        stats['served_from_cache'] = round(stats['hits'] / total, 3) if total else 0.0
+        return stats
+    
+    @staticmethod
+    def _key(topic, articles):
+        parts = [datetime.utcnow().strftime('%Y-%m-%d'), normalize_topic(topic)]
+        parts.extend(article.get('url') or '' for article in articles)
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+class ScanProgress:
+    """Resumable position in a parallel subscriptions scan.
+    
+    For each segment it tracks the pages handed to the run and which of
+    their users are still unfinished. A segment's cursor is the start key of
+    its oldest unfinished page plus every email completed from that page
+    onwards, so a resumed scan starts there and skips finished users.
+    Finished pages before that one are dropped as soon as they can no longer
+    be part of a cursor, so memory stays flat however long the scan runs.
+    """
+    
+    def __init__(self, cursor=None):
+        self.start_keys = {}
+        self.skip_emails = {}
+        self.done_segments = set()
+        self.failed_segments = set()
+        self._pages = {}
+        self._page_of = {}
+        self._lock = threading.Lock()
+        
+        for segment, entry in (cursor or {}).items():
+            if entry == 'done':
+                self.done_segments.add(int(segment))
+            else:
+                self.start_keys[int(segment)] = entry['start_key']
+                self.skip_emails[int(segment)] = set(entry['completed_emails'])
+    
+    def is_completed(self, segment, email):
+        return email in self.skip_emails.get(segment, ())
+    
+    def page_received(self, segment, start_key):
+        with self._lock:
+            pages = self._pages.setdefault(segment, [])
+            pages.append({
+                'segment': segment,
+                'start_key': start_key,
+                'pending': set(),
+                'completed': [],
+                'first': not pages
+            })
+            self._prune(segment)
+    
+    def user_received(self, segment, email):
+        with self._lock:
+            page = self._pages[segment][-1]
+            page['pending'].add(email)
+            self._page_of[email] = page
+    
+    def user_completed(self, email):
+        with self._lock:
+            page = self._page_of.pop(email, None)
+            if page:
+                page['pending'].discard(email)
+                page['completed'].append(email)
+                if not page['pending']:
+                    self._prune(page['segment'])
+    
+    def segment_finished(self, segment):
+        with self._lock:
+            self.done_segments.add(segment)
+    
+    def segment_failed(self, segment):
+        with self._lock:
+            self.failed_segments.add(segment)
+    
+    def to_cursor(self, segments):
+        """Return a JSON-serializable cursor for the given segments"""
+        cursor = {}
+        with self._lock:
+            for segment in segments:
+                pages = self._pages.get(segment)
                 
-                processed_users += 1
-                print(f"✅ Successfully processed {email}")
+                if not pages:
+                    if segment in self.done_segments:
+                        cursor[str(segment)] = 'done'
+                    else:
+                        cursor[str(segment)] = {
+                            'start_key': self.start_keys.get(segment),
+                            'completed_emails': sorted(self.skip_emails.get(segment, ()))
+                        }
+                    continue
                 
-            except Exception as e:
-                print(f"Error processing user {email}: {str(e)}")
-                # Store error digest so user still gets something
-                error_digest = generate_error_digest(topic)
-                store_digest(email, topic, error_digest, 0)
-                continue
+                unfinished = [i for i, page in enumerate(pages) if page['pending']]
+                if not unfinished and segment in self.done_segments:
+                    cursor[str(segment)] = 'done'
+                    continue
+                
+                first = unfinished[0] if unfinished else len(pages) - 1
+                completed = [email for page in pages[first:] for email in page['completed']]
+                if pages[first]['first']:
+                    completed.extend(self.skip_emails.get(segment, ()))
+                
+                cursor[str(segment)] = {
+                    'start_key': pages[first]['start_key'],
+                    'completed_emails': sorted(completed)
+                }
+        return cursor
+    
+    def _prune(self, segment):
+        # Only the newest page gains users, so finished pages ahead of the
+        # oldest unfinished one never return to a cursor. Caller holds the lock.
+        pages = self._pages[segment]
+        drop = 0
+        while drop < len(pages) - 1 and not pages[drop]['pending']:
+            drop += 1
+        if drop:
+            del pages[:drop]
+
+class RunDeadline:
+    """Signals when the invocation is close enough to its timeout to stop"""
+    
+    def __init__(self, context, margin_ms):
+        self.context = context
+        self.margin_ms = margin_ms
+    
+    def reached(self):
+        # Local runs (e.g. process-pool shards) have no Lambda context
+        if self.context is None:
+            return False
+        return self.context.get_remaining_time_in_millis() < self.margin_ms
+
+class DigestSink:
+    """Buffers digest items and writes them with DynamoDB batch writes.
+    
+    Items are flushed once flush_size are buffered, and callers flush
+    explicitly at batch boundaries and shutdown. batch_writer resends any
+    unprocessed items; if a batch still fails, each item is retried on its
+    own so one bad digest cannot take the rest of the batch with it. Emails
+    whose digest still could not be stored are returned by the next flush.
+    """
+    
+    def __init__(self, table_name, flush_size):
+        self.table_name = table_name
+        self.flush_size = flush_size
+        self._buffer = []
+        self._failed = []
+        self._lock = threading.Lock()
+    
+    def add(self, item):
+        with self._lock:
+            self._buffer.append(item)
+            if len(self._buffer) < self.flush_size:
+                return
+            items, self._buffer = self._buffer, []
+        self._write(items)
+    
+    def flush(self):
+        """Write buffered items; returns the emails not stored since the last flush"""
+        with self._lock:
+            items, self._buffer = self._buffer, []
+        if items:
+            self._write(items)
+        
+        with self._lock:
+            failed, self._failed = self._failed, []
+        return failed
+    
+    @metrics.timed('digest_sink_write')
+    def _write(self, items):
+        table = thread_dynamodb().Table(self.table_name)
+        
+        try:
+            # overwrite_by_pkeys drops duplicate keys that would fail the batch
+            with table.batch_writer(overwrite_by_pkeys=['email', 'digest_date']) as writer:
+                for item in items:
+                    writer.put_item(Item=item)
+            print(f"Stored {len(items)} digests")
+            metrics.increment('digests.stored', len(items))
+            
+        except Exception as e:
+            print(f"Batch digest write failed, retrying individually: {str(e)}")
+            metrics.increment('digest_sink.individual_retries', len(items))
+            for item in items:
+                try:
+                    table.put_item(Item=item)
+                    print(f"Stored digest for {item['email']}")
+                    metrics.increment('digests.stored')
+                except Exception as item_error:
+                    print(f"Error storing digest for {item['email']}: {str(item_error)}")
+                    metrics.increment('digests.store_errors')
+                    with self._lock:
+                        self._failed.append(item['email'])
+
+class WatermarkSink:
+    """Buffers subscriber watermark updates and applies them as PartiQL batches.
+    
+    Once a digest with articles is generated, the subscription's
+    last_processed moves to the generation time and the digest's URLs are
+    put in front of its recent_urls (capped at RECENT_URL_LIMIT). Each update
+    is conditioned on the topic the digest was written for, so a subscriber
+    who changed topic mid-run starts from a full window. Failed updates are
+    only logged: the next run then uses the older, wider window.
+    """
+    
+    BATCH_SIZE = 25  # BatchExecuteStatement limit
+    
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self._buffer = []
+        self._lock = threading.Lock()
+    
+    def add(self, user, articles):
+        recent_urls = [article['url'] for article in articles if article.get('url')]
+        recent_urls = list(dict.fromkeys(recent_urls + list(user.get('recent_urls') or [])))[:RECENT_URL_LIMIT]
+        statement = {
+            'Statement': (
+                f'UPDATE "{self.table_name}" '
+                f'SET "last_processed" = ? SET "recent_urls" = ? '
+                f'WHERE "email" = ? AND "topic" = ?'
+            ),
+            'Parameters': [
+                {'S': datetime.utcnow().isoformat()},
+                {'L': [{'S': url} for url in recent_urls]},
+                {'S': user['email']},
+                {'S': user['topic']}
+            ]
+        }
+        
+        with self._lock:
+            self._buffer.append(statement)
+            if len(self._buffer) < self.BATCH_SIZE:
+                return
+            statements, self._buffer = self._buffer, []
+        self._write(statements)
+    
+    def flush(self):
+        with self._lock:
+            statements, self._buffer = self._buffer, []
+        for i in range(0, len(statements), self.BATCH_SIZE):
+            self._write(statements[i:i + self.BATCH_SIZE])
+    
+    @metrics.timed('watermark_sink_write')
+    def _write(self, statements):
+        try:
+            response = dynamodb_client.batch_execute_statement(Statements=statements)
+        except Exception as e:
+            print(f"Error updating subscriber watermarks: {str(e)}")
+            metrics.increment('watermarks.errors', len(statements))
+            return
+        
+        failed = sum(1 for result in response['Responses'] if result.get('Error'))
+        metrics.increment('watermarks.updated', len(statements) - failed)
+        metrics.increment('watermarks.skipped', failed)
+
+class TopicClusterer:
+    """Groups near-identical subscription topics so they share keywords and fetches.
+    
+    Topics are embedded and compared by cosine similarity against the
+    representatives of existing clusters; a topic joins the most similar
+    cluster at or above the threshold, otherwise it starts a new one.
+    The local hashing embedding catches rewordings and spelling variants
+    ("electric vehicle" / "electric vehicles"); Bedrock embeddings also
+    catch synonyms ("EV news" / "electric cars").
+    
+    Representatives are bucketed by random-hyperplane LSH bands, so a topic
+    is only compared with those sharing a bucket instead of all of them; a
+    pair right at the threshold is still found about 85% of the time, and
+    a miss only costs a separate cluster. Clusters last for one run (see
+    reset) and stop growing at TOPIC_CLUSTER_LIMIT representatives.
+    """
+    
+    def __init__(self, method, threshold, max_clusters=TOPIC_CLUSTER_LIMIT):
+        self.method = method
+        self.threshold = threshold
+        self.max_clusters = max_clusters
+        self._np = None
+        self._hyperplanes = None
+        self._embeddings = LRUCache(4096)
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Forget all clusters, e.g. at the start of a run"""
+        with self._lock:
+            self.representatives = []
+            self.assignments = {}
+            self._vectors = None
+            self._buckets = {}
+    
+    @property
+    def enabled(self):
+        return self.method in ('hashing', 'bedrock') and self._load_numpy()
+    
+    def assign(self, topics):
+        """Return a dict mapping each topic to its cluster's representative topic"""
+        with self._lock:
+            if not self.enabled:
+                return {topic: topic for topic in topics}
+            
+            mapping = {}
+            for topic in topics:
+                key = normalize_topic(topic)
+                if key not in self.assignments:
+                    self.assignments[key] = self._cluster(topic)
+                mapping[topic] = self.assignments[key]
+            return mapping
+    
+    def summary(self):
+        return {'topics': len(self.assignments), 'clusters': len(self.representatives)}
+    
+    def _load_numpy(self):
+        # NumPy takes ~60 ms to import, so it is only loaded once clustering is used
+        if self._np is None:
+            try:
+                import numpy
+                self._np = numpy
+            except ImportError:
+                self._np = False
+                print("NumPy is not available, topic clustering is off (attach the NumPy layer)")
+        return bool(self._np)
+    
+    def _cluster(self, topic):
+        np = self._np
+        vector = self._embed(topic)
+        count = len(self.representatives)
+        bands = self._bands(vector)
+        
+        candidates = sorted({index for band in bands for index in self._buckets.get(band, ())})
+        if candidates:
+            similarities = self._vectors[candidates] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                return self.representatives[candidates[best]]
+        
+        if count >= self.max_clusters:
+            return topic
+        
+        # Grow the representative matrix geometrically (up to the limit) to keep appends cheap
+        if self._vectors is None:
+            self._vectors = np.zeros((min(64, self.max_clusters), vector.shape[0]), dtype=np.float32)
+        elif count == self._vectors.shape[0]:
+            extra = min(count, self.max_clusters - count)
+            self._vectors = np.vstack([self._vectors, np.zeros((extra, vector.shape[0]), dtype=np.float32)])
+        
+        self._vectors[count] = vector
+        self.representatives.append(topic)
+        for band in bands:
+            self._buckets.setdefault(band, []).append(count)
+        return topic
+    
+    def _bands(self, vector):
+        np = self._np
+        # Sign bits of random projections, split into bands; similar vectors share bands
+        if self._hyperplanes is None or self._hyperplanes.shape[0] != vector.shape[0]:
+            rng = np.random.default_rng(0)
+            self._hyperplanes = rng.standard_normal(
+                (vector.shape[0], TOPIC_LSH_BANDS * TOPIC_LSH_BAND_BITS)
+            ).astype(np.float32)
+        # Hashed topic vectors are sparse, so only their nonzero rows are projected
+        nonzero = np.flatnonzero(vector)
+        projection = vector[nonzero] @ self._hyperplanes[nonzero]
+        bits = (projection > 0).reshape(TOPIC_LSH_BANDS, TOPIC_LSH_BAND_BITS)
+        keys = bits @ (1 << np.arange(TOPIC_LSH_BAND_BITS))
+        return list(enumerate(keys.tolist()))
+    
+    def _embed(self, topic):
+        key = normalize_topic(topic)
+        vector = self._embeddings.get(key)
+        if vector is None:
+            if self.method == 'bedrock':
+                vector = embed_topic_bedrock(key)
+            else:
+                vector = embed_topic_hashing(key)
+            self._embeddings.put(key, vector)
+        return vector
+
+def embed_topic_hashing(topic):
+    """Embed a normalized topic with a signed hashing vectorizer.
+    
+    Features are content words plus character trigrams of each word, so
+    plural/singular forms and small spelling differences stay close.
+    """
+    import numpy as np
+    
+    vector = np.zeros(TOPIC_HASH_DIM, dtype=np.float32)
+    words = [word for word in topic.split() if word not in TOPIC_STOPWORDS] or topic.split()
+    
+    features = list(words)
+    for word in words:
+        padded = f"<{word}>"
+        features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    
+    for feature in features:
+        # crc32 is stable across processes, unlike hash()
+        hashed = zlib.crc32(feature.encode('utf-8'))
+        sign = 1.0 if hashed & 0x80000000 else -1.0
+        vector[hashed % TOPIC_HASH_DIM] += sign
+    
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def embed_topic_bedrock(topic):
+    """Embed a normalized topic with Titan text embeddings (unit length)"""
+    import numpy as np
+    
+    response = embedding_guard.call(
+        bedrock.invoke_model,
+        modelId=EMBEDDING_MODEL_ID,
+        body=json.dumps({'inputText': topic, 'dimensions': EMBEDDING_DIM, 'normalize': True}),
+        contentType="application/json"
+    )
+    embedding = json.loads(response['body'].read())['embedding']
+    return np.asarray(embedding, dtype=np.float32)
+
+def cluster_topics(topics):
+    """Map topics to cluster representatives, or to themselves if clustering fails"""
+    try:
+        mapping = topic_clusterer.assign(topics)
+        print(f"Topic clusters: {topic_clusterer.summary()}")
+        return mapping
+    except Exception as e:
+        print(f"Topic clustering failed: {str(e)}")
+        return {topic: topic for topic in topics}
+
+def normalize_keyword(keyword):
+    """Normalize a search keyword; News API queries are case-insensitive"""
+    return ' '.join(keyword.lower().split())
+
+NEWS_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def news_timestamp(moment):
+    """Format a UTC datetime like News API's publishedAt, so the two compare as strings"""
+    return moment.strftime(NEWS_TIMESTAMP_FORMAT)
+
+def news_lookback_floor():
+    """Oldest publish time ever searched, rounded down to the hour"""
+    floor = datetime.utcnow() - timedelta(days=NEWS_LOOKBACK_DAYS)
+    return news_timestamp(floor.replace(minute=0, second=0, microsecond=0))
+
+def subscriber_watermark(user):
+    """Publish time from which a subscriber's next digest draws articles.
+    
+    Subscribers who have had a digest (and so have recent_urls) get articles
+    since their last_processed time less NEWS_WATERMARK_OVERLAP_HOURS; new
+    subscribers get the full lookback. Rounded down to the hour so users
+    processed in the same run share fetches and cached rankings.
+    """
+    floor = news_lookback_floor()
+    if not user.get('recent_urls'):
+        return floor
+    
+    try:
+        last_processed = datetime.fromisoformat(user['last_processed'])
+    except (KeyError, TypeError, ValueError):
+        return floor
+    
+    since = last_processed - timedelta(hours=NEWS_WATERMARK_OVERLAP_HOURS)
+    return max(floor, news_timestamp(since.replace(minute=0, second=0, microsecond=0)))
+
+# Module-level so the in-process layers are reused across warm invocations
+keyword_cache = TopicKeywordCache(KEYWORD_CACHE_TABLE, KEYWORD_CACHE_SIZE, KEYWORD_CACHE_TTL_DAYS)
+article_cache = ArticleFetchCache()
+article_corpus = ArticleCorpus()
+digest_cache = DigestCache(DIGEST_CACHE_SIZE)
+digest_sink = DigestSink(DIGESTS_TABLE, DIGEST_FLUSH_SIZE)
+watermark_sink = WatermarkSink(SUBSCRIPTIONS_TABLE)
+topic_clusterer = TopicClusterer(TOPIC_CLUSTERING, TOPIC_SIMILARITY_THRESHOLD)
+fingerprint_cache = LRUCache(FINGERPRINT_CACHE_SIZE)
+
+def lambda_handler(event, context):
+    print(f"Starting daily digest generation at {datetime.utcnow()}")
+    
+    try:
+        event = event or {}
+        mode = event.get('mode')
+        execution_mode = event.get('execution_mode', EXECUTION_MODE)
+        print(f"Execution mode: {execution_mode}")
+        
+        if mode == 'orchestrator':
+            return run_orchestrator(event, context)
+        
+        shard = int(event.get('shard', 0))
+        total_shards = int(event.get('total_shards', 1))
+        resume = bool(event.get('resume'))
+        if mode == 'worker':
+            print(f"Worker processing shard {shard + 1}/{total_shards}")
+        
+        result = run_shard(shard, total_shards, execution_mode, context, resume)
+        
+        if result['checkpointed']:
+            if not result['finished_users']:
+                # Resuming would only checkpoint again, in an endless chain of invocations
+                print("Checkpointed without finishing any users, not resuming")
+                return {
+                    'statusCode': 500,
+                    'body': json.dumps({
+                        'error': 'Checkpointed without finishing any users; check the timeout and CHECKPOINT_MARGIN_MS',
+                        **result
+                    })
+                }
+            
+            if RESUME_SELF_INVOKE:
+                schedule_resume(context, {
+                    'mode': mode,
+                    'shard': shard,
+                    'total_shards': total_shards,
+                    'execution_mode': execution_mode,
+                    'resume': True
+                })
+            
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'message': f"Checkpointed after {result['total_users']} users, resuming",
+                    **result
+                })
+            }
+        
+        if not result['total_users']:
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'message': 'No active subscriptions found'})
+            }
         
         return {
             'statusCode': 200,
             'body': json.dumps({
-                'message': f'Generated digests for {processed_users} users',
-                'total_users': len(active_users)
+                'message': f"Generated digests for {result['processed_users']} users",
+                **result
             })
         }
         
@@ -85,26 +1105,895 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
         }
+    
+    finally:
+        pickle_runtime.report(metrics)
+        metrics.flush(context)
 
-def get_active_subscriptions():
-    """Fetch all active subscriptions from DynamoDB"""
+def run_shard(shard, total_shards, execution_mode=EXECUTION_MODE, context=None, resume=False):
+    """Run the per-user pipeline over one shard of the subscriber set.
+    
+    Shard i of N owns scan segments i*SCAN_SEGMENTS .. (i+1)*SCAN_SEGMENTS-1
+    out of N*SCAN_SEGMENTS, so shards never overlap and each worker still
+    runs its own parallel scan. If the invocation nears its timeout the scan
+    position is checkpointed so a follow-up invocation can resume, and users
+    who already have today's digest are always skipped. Returns run counts.
+    """
+    total_segments = total_shards * SCAN_SEGMENTS
+    segments = range(shard * SCAN_SEGMENTS, (shard + 1) * SCAN_SEGMENTS)
+    run_id = f"{datetime.utcnow().strftime('%Y-%m-%d')}#{shard}/{total_shards}"
+    
+    # Clusters from a previous warm invocation would only grow the search
+    topic_clusterer.reset()
+    
+    # Each shard paces itself to its share of the provider-wide ceilings
+    news_guard.limiter.set_max_rate(NEWS_API_MAX_RATE / total_shards)
+    bedrock_guard.limiter.set_max_rate(BEDROCK_MAX_RATE / total_shards)
+    embedding_guard.limiter.set_max_rate(BEDROCK_MAX_RATE / total_shards)
+    
+    checkpoint = load_checkpoint(run_id) if resume else None
+    if checkpoint and checkpoint.get('status') == 'complete':
+        print(f"Run {run_id} already complete, nothing to resume")
+        return {'processed_users': 0, 'total_users': 0, 'skipped_users': 0, 'checkpointed': False, 'finished_users': 0}
+    
+    if checkpoint:
+        print(f"Resuming run {run_id} from checkpoint")
+    
+    progress = ScanProgress(json.loads(checkpoint['cursor']) if checkpoint else None)
+    deadline = RunDeadline(context, CHECKPOINT_MARGIN_MS)
+    counts = {
+        'processed_users': int(checkpoint.get('processed_users', 0)) if checkpoint else 0,
+        'total_users': int(checkpoint.get('total_users', 0)) if checkpoint else 0,
+        'skipped_users': int(checkpoint.get('skipped_users', 0)) if checkpoint else 0
+    }
+    checkpointed = False
+    finished_users_now = 0
+    
+    # Stream active subscriptions; batches are processed as pages arrive
+    subscriptions = iter_active_subscriptions(total_segments, segments, progress)
     try:
-        table = dynamodb.Table(SUBSCRIPTIONS_TABLE)
-        
-        response = table.scan(
-            FilterExpression='#status = :status',
-            ExpressionAttributeNames={'#status': 'status'},
-            ExpressionAttributeValues={':status': 'active'}
+        for batch in pickle_runtime.iter_batches(subscriptions, USER_BATCH_SIZE):
+            pending_users = filter_pending_users(batch, progress)
+            counts['skipped_users'] += len(batch) - len(pending_users)
+            counts['total_users'] += len(batch) - len(pending_users)
+            
+            if execution_mode == 'pipelined':
+                import asyncio  # ~50 ms to import, so only loaded for pipelined runs
+                processed_users, finished_users = asyncio.run(
+                    process_batch_pipelined(pending_users, deadline, progress)
+                )
+            else:
+                processed_users, finished_users = process_batch(pending_users, deadline, progress)
+            
+            counts['processed_users'] += processed_users
+            counts['total_users'] += finished_users
+            finished_users_now += len(batch) - len(pending_users) + finished_users
+            
+            # Write the batch before it counts as done in a checkpoint. Watermarks
+            # are only queued for digests that were stored (see flush_batch_digests)
+            digest_sink.flush()
+            watermark_sink.flush()
+            
+            if deadline.reached():
+                save_checkpoint(run_id, progress.to_cursor(segments), counts)
+                checkpointed = True
+                break
+    finally:
+        # Stops the scan workers if we broke out early
+        subscriptions.close()
+        digest_sink.flush()
+        watermark_sink.flush()
+    
+    if progress.failed_segments and not checkpointed:
+        # Those segments' subscribers are still owed a digest, so resume rather than complete
+        print(f"Scan segments {sorted(progress.failed_segments)} failed, checkpointing to retry them")
+        save_checkpoint(run_id, progress.to_cursor(segments), counts)
+        checkpointed = True
+    
+    if checkpoint and not checkpointed:
+        complete_checkpoint(run_id, counts)
+    
+    print(f"Found {counts['total_users']} active subscriptions ({counts['skipped_users']} already had today's digest)")
+    print(f"Keyword cache: {keyword_cache.summary()}")
+    print(f"Article cache: {article_cache.summary()}")
+    print(f"Digest cache: {digest_cache.summary()}")
+    
+    return {**counts, 'checkpointed': checkpointed, 'finished_users': finished_users_now}
+
+def filter_pending_users(users, progress=None):
+    """Drop users who already have a digest stored for today.
+    
+    This makes reruns and resumed invocations idempotent. Skipped users are
+    marked completed in the scan progress.
+    """
+    if not users:
+        return []
+    
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    existing = set()
+    
+    try:
+        # BatchGetItem accepts at most 100 keys per request
+        for i in range(0, len(users), 100):
+            request = {
+                DIGESTS_TABLE: {
+                    'Keys': [{'email': user['email'], 'digest_date': today} for user in users[i:i + 100]],
+                    'ProjectionExpression': 'email'
+                }
+            }
+            
+            attempt = 0
+            while request:
+                response = thread_dynamodb().batch_get_item(RequestItems=request)
+                existing.update(item['email'] for item in response['Responses'].get(DIGESTS_TABLE, []))
+                request = response.get('UnprocessedKeys')
+                if request:
+                    attempt += 1
+                    time.sleep(min(2 ** attempt * 0.05, 2))
+                    
+    except Exception as e:
+        # Regenerating is better than skipping users we are unsure about
+        print(f"Error checking existing digests: {str(e)}")
+    
+    pending_users = []
+    for user in users:
+        if user['email'] in existing:
+            print(f"Skipping {user['email']}: digest already generated today")
+            if progress:
+                progress.user_completed(user['email'])
+        else:
+            pending_users.append(user)
+    
+    return pending_users
+
+def load_checkpoint(run_id):
+    """Load a saved run checkpoint, or None if there is none"""
+    try:
+        table = thread_dynamodb().Table(CHECKPOINTS_TABLE)
+        return table.get_item(Key={'run_id': run_id}).get('Item')
+    except Exception as e:
+        print(f"Error loading checkpoint {run_id}: {str(e)}")
+        return None
+
+def save_checkpoint(run_id, cursor, counts):
+    """Persist the scan cursor and counts so a later invocation can resume"""
+    table = thread_dynamodb().Table(CHECKPOINTS_TABLE)
+    table.put_item(Item={
+        'run_id': run_id,
+        'status': 'in_progress',
+        'cursor': json.dumps(cursor),
+        **counts,
+        'updated_at': datetime.utcnow().isoformat(),
+        'ttl': int((datetime.utcnow() + timedelta(days=3)).timestamp())
+    })
+    print(f"Saved checkpoint for {run_id} after {counts['total_users']} users")
+
+def complete_checkpoint(run_id, counts):
+    """Mark a resumed run as finished so stray resumes do nothing"""
+    try:
+        table = thread_dynamodb().Table(CHECKPOINTS_TABLE)
+        table.put_item(Item={
+            'run_id': run_id,
+            'status': 'complete',
+            **counts,
+            'updated_at': datetime.utcnow().isoformat(),
+            'ttl': int((datetime.utcnow() + timedelta(days=3)).timestamp())
+        })
+    except Exception as e:
+        print(f"Error completing checkpoint {run_id}: {str(e)}")
+
+def schedule_resume(context, payload):
+    """Asynchronously invoke this function to continue from the checkpoint"""
+    try:
+        lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps(payload)
         )
+        print("Scheduled resume invocation")
+    except Exception as e:
+        print(f"Error scheduling resume: {str(e)}")
+
+def run_orchestrator(event, context):
+    """Partition subscribers into shards, dispatch workers and aggregate results.
+    
+    Workers are invocations of this function in 'worker' mode. With
+    SHARD_DISPATCH=local a process pool stands in for Lambda, which is
+    useful for local runs (Lambda itself has no /dev/shm for process pools).
+    """
+    total_shards = int(event.get('shards', SHARD_COUNT))
+    execution_mode = event.get('execution_mode', EXECUTION_MODE)
+    dispatch = event.get('dispatch', SHARD_DISPATCH)
+    print(f"Orchestrating {total_shards} shards via {dispatch} dispatch")
+    
+    if dispatch == 'local':
+        # Imports multiprocessing, so only loaded for local dispatch
+        from concurrent.futures import ProcessPoolExecutor
         
-        return response.get('Items', [])
+        with ProcessPoolExecutor(max_workers=total_shards) as pool:
+            futures = [
+                pool.submit(run_local_shard, shard, total_shards, execution_mode)
+                for shard in range(total_shards)
+            ]
+            results = [collect_shard_result(shard, future.result) for shard, future in enumerate(futures)]
+    else:
+        function_name = WORKER_FUNCTION_NAME or context.function_name
+        with ThreadPoolExecutor(max_workers=total_shards) as pool:
+            futures = [
+                pool.submit(invoke_worker, function_name, shard, total_shards, execution_mode)
+                for shard in range(total_shards)
+            ]
+            results = [collect_shard_result(shard, future.result) for shard, future in enumerate(futures)]
+    
+    processed_users = sum(result['processed_users'] for result in results if result)
+    total_users = sum(result['total_users'] for result in results if result)
+    failed_shards = [shard for shard, result in enumerate(results) if result is None]
+    checkpointed_shards = [shard for shard, result in enumerate(results) if result and result['checkpointed']]
+    
+    return {
+        'statusCode': 200 if not failed_shards else 500,
+        'body': json.dumps({
+            'message': f'Generated digests for {processed_users} users across {total_shards} shards',
+            'processed_users': processed_users,
+            'total_users': total_users,
+            'failed_shards': failed_shards,
+            'checkpointed_shards': checkpointed_shards
+        })
+    }
+
+def run_local_shard(shard, total_shards, execution_mode):
+    """Process-pool entry point: run a shard and emit its own metrics"""
+    try:
+        return run_shard(shard, total_shards, execution_mode)
+    finally:
+        pickle_runtime.report(metrics)
+        metrics.flush()
+
+def collect_shard_result(shard, get_result):
+    """Return a shard's run counts, or None if it failed"""
+    try:
+        result = get_result()
+        print(f"Shard {shard}: processed {result['processed_users']}/{result['total_users']} users")
+        return result
+    except Exception as e:
+        print(f"Shard {shard} failed: {str(e)}")
+        return None
+
+def invoke_worker(function_name, shard, total_shards, execution_mode):
+    """Synchronously invoke a worker Lambda for one shard"""
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='RequestResponse',
+        Payload=json.dumps({
+            'mode': 'worker',
+            'shard': shard,
+            'total_shards': total_shards,
+            'execution_mode': execution_mode
+        })
+    )
+    
+    if response.get('FunctionError'):
+        raise Exception(f"Worker error: {response['Payload'].read().decode('utf-8')}")
+    
+    result = json.loads(response['Payload'].read())
+    body = json.loads(result['body'])
+    if result['statusCode'] != 200:
+        raise Exception(body.get('error', 'Worker failed'))
+    
+    return {
+        'processed_users': body.get('processed_users', 0),
+        'total_users': body.get('total_users', 0),
+        'checkpointed': body.get('checkpointed', False)
+    }
+
+def process_batch(users, deadline=None, progress=None):
+    """Generate and store digests for a batch of subscribers.
+    
+    Topics are clustered first so near-identical subscriptions share one
+    set of keywords, then keywords are generated for the whole batch (a few
+    batched LLM prompts for uncached topics) so the distinct keywords can be
+    fetched once and shared by every user's ranking step. Each user only
+    gets articles published since their watermark that they were not sent
+    before. Stops early once the deadline is reached. Returns a tuple of
+    (users processed successfully, users finished).
+    """
+    cluster_of = cluster_topics([user['topic'] for user in users])
+    
+    keywords_by_topic = {}
+    try:
+        keywords_by_topic = generate_keywords_batch(list(dict.fromkeys(cluster_of.values())))
+    except Exception as e:
+        print(f"Error generating batch keywords: {str(e)}")
+    
+    keywords_by_email = {}
+    for user in users:
+        cluster_topic = cluster_of[user['topic']]
+        try:
+            if cluster_topic in keywords_by_topic:
+                keywords_by_email[user['email']] = keywords_by_topic[cluster_topic]
+            else:
+                keywords_by_email[user['email']] = generate_keywords_with_llm(cluster_topic)
+        except Exception as e:
+            print(f"Error generating keywords for {user['email']}: {str(e)}")
+    
+    # Each user only needs articles published since their last digest
+    watermarks = {user['email']: subscriber_watermark(user) for user in users}
+    
+    # Fan in: fetch each distinct search keyword once for the whole batch
+    prefetch_articles(
+        (keyword, watermarks[email])
+        for email, keywords in keywords_by_email.items()
+        for keyword in keywords[:SEARCH_KEYWORD_LIMIT]
+    )
+    
+    processed_users = 0
+    finished_users = 0
+    articles_by_cluster = {}
+    generated = {}
+    
+    for user in users:
+        if deadline and deadline.reached():
+            print("Approaching timeout, stopping batch early")
+            break
+        
+        email = user['email']
+        topic = user['topic']
         
+        print(f"Generating digest for {email}: {topic}")
+        
+        try:
+            # Step 1: Generate keywords using LLM
+            if email not in keywords_by_email:
+                raise Exception("Keyword generation failed")
+            keywords = keywords_by_email[email]
+            print(f"Generated keywords: {keywords}")
+            
+            # Step 2: Fetch new articles using keywords, once per topic cluster
+            # and window; articles already sent to this user are left out
+            recent_urls = frozenset(user.get('recent_urls') or ())
+            ranking_key = (cluster_of[topic], watermarks[email], recent_urls)
+            if ranking_key not in articles_by_cluster:
+                articles_by_cluster[ranking_key] = fetch_news_articles(keywords, watermarks[email], recent_urls)
+            articles = articles_by_cluster[ranking_key]
+            print(f"Found {len(articles)} articles")
+            
+            # Step 3: Generate final digest content
+            digest_content = generate_digest_content(topic, articles)
+            
+            # Step 4: Store ready-to-send digest (the watermark advances once it is written)
+            store_digest(email, topic, digest_content, len(articles))
+            generated[email] = articles
+            
+            processed_users += 1
+            print(f"✅ Successfully processed {email}")
+            
+        except Exception as e:
+            print(f"Error processing user {email}: {str(e)}")
+            # Store error digest so user still gets something
+            error_digest = generate_error_digest(topic)
+            store_digest(email, topic, error_digest, 0)
+            continue
+        
+        finally:
+            finished_users += 1
+            if progress:
+                progress.user_completed(email)
+    
+    processed_users -= len(flush_batch_digests(users, generated))
+    return processed_users, finished_users
+
+def flush_batch_digests(users, generated):
+    """Write a batch's buffered digests, then advance the stored users' watermarks.
+    
+    A user whose digest could not be written goes through the same error
+    path as when store_digest failed: the failure is logged and an error
+    digest is stored instead, and their watermark stays where it was so
+    tomorrow's window still covers these articles. generated maps the
+    emails whose digest was generated to its articles. Returns the emails
+    among them not stored.
+    """
+    failed = set(digest_sink.flush())
+    unstored = failed & set(generated)
+    
+    for user in users:
+        email = user['email']
+        if email not in generated:
+            continue
+        if email not in unstored:
+            if generated[email]:
+                watermark_sink.add(user, generated[email])
+            continue
+        
+        print(f"Error processing user {email}: Error storing digest")
+        try:
+            # Store error digest so user still gets something
+            store_digest(email, user['topic'], generate_error_digest(user['topic']), 0)
+        except Exception as e:
+            print(f"Error storing error digest for {email}: {str(e)}")
+    
+    if unstored:
+        digest_sink.flush()
+    return unstored
+
+async def process_batch_pipelined(users, deadline=None, progress=None):
+    """Generate and store digests for a batch with many users in flight.
+    
+    Each user still runs keywords -> fetch -> digest -> store in order, but
+    up to USER_CONCURRENCY users overlap, and each stage has its own limit
+    so Bedrock, News API and DynamoDB are never oversubscribed. The blocking
+    boto3/requests calls run on worker threads. Users not yet started when
+    the deadline is reached are left for the next invocation. Returns a
+    tuple of (users processed successfully, users finished).
+    """
+    import asyncio
+    
+    limits = {
+        'users': asyncio.Semaphore(USER_CONCURRENCY),
+        'bedrock': asyncio.Semaphore(BEDROCK_CONCURRENCY),
+        'news': asyncio.Semaphore(NEWS_FETCH_CONCURRENCY),
+        'dynamodb': asyncio.Semaphore(DYNAMODB_CONCURRENCY)
+    }
+    
+    # Cluster topics, then generate their keywords with a few batched prompts
+    cluster_of = await run_stage(limits['bedrock'], cluster_topics, [user['topic'] for user in users])
+    keywords_by_topic = {}
+    try:
+        keywords_by_topic = await run_stage(
+            limits['bedrock'], generate_keywords_batch, list(dict.fromkeys(cluster_of.values()))
+        )
     except Exception as e:
-        print(f"Error fetching subscriptions: {str(e)}")
-        return []
+        print(f"Error generating batch keywords: {str(e)}")
+    
+    generated = {}
+    results = await asyncio.gather(*(
+        process_user_pipelined(
+            user, limits, deadline, progress, cluster_of[user['topic']], generated,
+            keywords_by_topic.get(cluster_of[user['topic']])
+        )
+        for user in users
+    ))
+    processed_users = sum(1 for result in results if result)
+    finished_users = sum(1 for result in results if result is not None)
+    
+    processed_users -= len(await run_in_pipeline(flush_batch_digests, users, generated))
+    return processed_users, finished_users
+
+async def run_stage(limit, func, *args):
+    """Run a blocking stage on a worker thread under its concurrency limit"""
+    async with limit:
+        return await run_in_pipeline(func, *args)
+
+def run_in_pipeline(func, *args):
+    """Run a blocking call on the shared pipeline pool from the event loop"""
+    import asyncio
+    
+    return asyncio.get_running_loop().run_in_executor(pipeline_pool, func, *args)
+
+async def process_user_pipelined(user, limits, deadline=None, progress=None, cluster_topic=None, generated=None,
+                                 keywords=None):
+    """Run the per-user pipeline.
+    
+    Keywords come from the user's topic cluster representative when given;
+    the digest itself is still written for the user's own topic. keywords
+    already generated for the batch skip the keyword stage. Returns
+    True if the digest was generated (and records its articles in
+    generated), False if an error digest was stored instead, and None if
+    the user was left for a later invocation.
+    """
+    email = user['email']
+    topic = user['topic']
+    
+    async with limits['users']:
+        if deadline and deadline.reached():
+            return None
+        
+        print(f"Generating digest for {email}: {topic}")
+        
+        try:
+            # Step 1: Generate keywords using LLM, unless the batch already did
+            if keywords is None:
+                keywords = await run_stage(limits['bedrock'], generate_keywords_with_llm, cluster_topic or topic)
+            print(f"Generated keywords for {email}: {keywords}")
+            
+            # Step 2: Fetch articles published since the user's last digest
+            articles = await run_stage(
+                limits['news'], fetch_news_articles,
+                keywords, subscriber_watermark(user), user.get('recent_urls') or ()
+            )
+            print(f"Found {len(articles)} articles for {email}")
+            
+            # Step 3: Generate final digest content
+            digest_content = await run_stage(limits['bedrock'], generate_digest_content, topic, articles)
+            
+            # Step 4: Store ready-to-send digest (the watermark advances once it is written)
+            await run_stage(limits['dynamodb'], store_digest, email, topic, digest_content, len(articles))
+            if generated is not None:
+                generated[email] = articles
+            
+            print(f"✅ Successfully processed {email}")
+            return True
+            
+        except Exception as e:
+            print(f"Error processing user {email}: {str(e)}")
+            # Store error digest so user still gets something
+            try:
+                error_digest = generate_error_digest(topic)
+                await run_stage(limits['dynamodb'], store_digest, email, topic, error_digest, 0)
+            except Exception as store_error:
+                print(f"Error storing error digest for {email}: {str(store_error)}")
+            return False
+        
+        finally:
+            if progress:
+                progress.user_completed(email)
 
-def generate_keywords_with_llm(user_topic):
-    """Generate search keywords from user topic using Bedrock"""
+def iter_active_subscriptions(total_segments=SCAN_SEGMENTS, segments=None, progress=None):
+    """Stream active subscriptions from DynamoDB using a paginated parallel scan.
+    
+    Each segment is scanned on its own worker thread, following
+    LastEvaluatedKey until the segment is exhausted. Pages are handed over
+    through a bounded queue, so memory stays flat regardless of table size
+    and callers can start on the first users while later pages load.
+    Pass segments to scan only a subset of the total_segments, and a
+    ScanProgress to record (and resume from) the scan position.
+    """
+    if segments is None:
+        segments = range(max(1, total_segments))
+    if progress:
+        segments = [segment for segment in segments if segment not in progress.done_segments]
+    
+    pages = queue.Queue(maxsize=len(segments) * SCAN_QUEUE_PAGES)
+    stop = threading.Event()
+    failed_segments = set()
+    
+    def scan_segment(segment):
+        try:
+            table = thread_dynamodb().Table(SUBSCRIPTIONS_TABLE)
+            
+            scan_kwargs = {
+                'FilterExpression': '#status = :status',
+                'ExpressionAttributeNames': {'#status': 'status'},
+                'ExpressionAttributeValues': {':status': 'active'},
+                'Limit': SCAN_PAGE_LIMIT
+            }
+            if total_segments > 1:
+                scan_kwargs['Segment'] = segment
+                scan_kwargs['TotalSegments'] = total_segments
+            if progress and progress.start_keys.get(segment):
+                scan_kwargs['ExclusiveStartKey'] = progress.start_keys[segment]
+            
+            while not stop.is_set():
+                start_key = scan_kwargs.get('ExclusiveStartKey')
+                response = table.scan(**scan_kwargs)
+                put_page((segment, start_key, response.get('Items', [])))
+                
+                last_key = response.get('LastEvaluatedKey')
+                if not last_key:
+                    break
+                scan_kwargs['ExclusiveStartKey'] = last_key
+                
+        except Exception as e:
+            print(f"Error fetching subscriptions (segment {segment}): {str(e)}")
+            failed_segments.add(segment)
+        finally:
+            put_page((segment, None, None))  # Signal that this segment is finished
+    
+    def put_page(page):
+        # Block while the consumer is behind, but give up once it has stopped
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                continue
+    
+    workers = [
+        threading.Thread(target=scan_segment, args=(segment,), daemon=True)
+        for segment in segments
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        remaining = len(workers)
+        while remaining:
+            segment, start_key, items = pages.get()
+            if items is None:
+                remaining -= 1
+                # Failed segments stay resumable from their last page
+                if progress and segment in failed_segments:
+                    progress.segment_failed(segment)
+                elif progress:
+                    progress.segment_finished(segment)
+                continue
+            
+            if progress:
+                progress.page_received(segment, start_key)
+            
+            for item in items:
+                if progress:
+                    if progress.is_completed(segment, item['email']):
+                        continue
+                    progress.user_received(segment, item['email'])
+                yield item
+    finally:
+        # Release scanners if the consumer stops early
+        stop.set()
+
+def thread_dynamodb():
+    """This thread's DynamoDB resource.
+    
+    boto3 resources are not thread-safe, and shards, scan segments and
+    pipeline stages all run on worker threads, so each thread gets its own.
+    """
+    resource = getattr(thread_state, 'dynamodb', None)
+    if resource is None:
+        resource = thread_state.dynamodb = new_dynamodb_resource()
+    return resource
+
+def new_dynamodb_resource():
+    """Create a DynamoDB resource for use on a single worker thread"""
+    return pickle_runtime.new_resource('dynamodb', region_name=REGION)
+
+@metrics.timed('invoke_llm')
+def invoke_llm(prompt, max_gen_len=MAX_TOKENS, stop_at=None):
+    """Run a prompt through the Bedrock model and return the generated text.
+    
+    stop_at(text) returns the index where the useful output ends, or None
+    while it is incomplete; anything after that is dropped. With
+    LLM_STREAMING the response is streamed and reading stops right there.
+    Calls go through bedrock_guard, so throttles are retried under the
+    shared rate limit.
+    """
+    request_body = {
+        "prompt": prompt,
+        "max_gen_len": max_gen_len,
+        "temperature": TEMPERATURE,
+        "top_p": 0.9
+    }
+    
+    if LLM_STREAMING:
+        return bedrock_guard.call(stream_llm, request_body, stop_at).strip()
+    
+    try:
+        response = bedrock_guard.call(
+            bedrock.invoke_model,
+            modelId=MODEL_ID,
+            body=json.dumps(request_body),
+            contentType="application/json"
+        )
+    except Exception:
+        metrics.increment('bedrock.errors')
+        raise
+    
+    response_body = json.loads(response['body'].read())
+    record_llm_usage(response_body)
+    
+    generation = response_body['generation']
+    end = stop_at(generation) if stop_at else None
+    return generation[:end].strip()
+
+def stream_llm(request_body, stop_at=None):
+    """Stream a generation, returning early once stop_at finds its end.
+    
+    Records time to first token. Closing the stream early stops reading
+    runaway output the caller would throw away. A throttle mid-stream
+    raises, and bedrock_guard restarts the generation.
+    """
+    started = time.perf_counter()
+    try:
+        response = bedrock.invoke_model_with_response_stream(
+            modelId=MODEL_ID,
+            body=json.dumps(request_body),
+            contentType="application/json"
+        )
+    except Exception:
+        metrics.increment('bedrock.errors')
+        raise
+    
+    stream = response['body']
+    pieces = []
+    usage = {}
+    try:
+        for event in stream:
+            chunk = event.get('chunk')
+            if not chunk:
+                continue
+            
+            payload = json.loads(chunk['bytes'])
+            usage.update({key: value for key, value in payload.items() if key != 'generation' and value is not None})
+            
+            piece = payload.get('generation') or ''
+            if not piece:
+                continue
+            if not pieces:
+                metrics.record_latency('llm_time_to_first_token', (time.perf_counter() - started) * 1000)
+            pieces.append(piece)
+            
+            if stop_at:
+                text = ''.join(pieces)
+                end = stop_at(text)
+                if end is not None:
+                    metrics.increment('bedrock.early_stops')
+                    record_llm_usage(usage)
+                    return text[:end]
+    
+    except Exception:
+        metrics.increment('bedrock.errors')
+        raise
+    
+    finally:
+        stream.close()
+    
+    record_llm_usage(usage)
+    return ''.join(pieces)
+
+def record_llm_usage(response_body):
+    """Count a Bedrock call and its tokens from a response (or last stream chunk)"""
+    metrics.increment('bedrock.calls')
+    metrics.increment('bedrock.input_tokens', response_body.get('prompt_token_count', 0))
+    metrics.increment('bedrock.output_tokens', response_body.get('generation_token_count', 0))
+    if response_body.get('stop_reason') == 'length':
+        metrics.increment('bedrock.truncated')
+
+def end_of_html(text):
+    """Stop condition for digests: right after the closing </html> tag"""
+    end = text.find('</html>')
+    return end + len('</html>') if end != -1 else None
+
+def end_of_first_line(text):
+    """Stop condition for the comma-separated keyword list"""
+    start = len(text) - len(text.lstrip())
+    end = text.find('\n', start)
+    return end if end != -1 else None
+
+def end_of_json_object(text):
+    """Stop condition for batched keywords: after the first complete JSON object"""
+    depth = 0
+    in_string = False
+    escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}' and depth:
+            depth -= 1
+            if not depth:
+                return i + 1
+    return None
+
+def clean_keywords(raw_keywords):
+    """Strip keywords, drop empty or one-letter ones and keep at most 7"""
+    keywords = [str(kw).strip() for kw in raw_keywords]
+    keywords = [kw for kw in keywords if kw and len(kw) >= 2]
+    return keywords[:7]  # Limit to 7 keywords
+
+def generate_keywords_batch(topics):
+    """Generate keywords for many topics, batching cache misses into few LLM calls.
+    
+    Returns a dict mapping each topic to its keywords. Topics the batch
+    response does not cover are sent through generate_keywords_with_llm.
+    """
+    keywords_by_topic = {}
+    misses = {}
+    
+    for topic in topics:
+        if topic in keywords_by_topic:
+            continue
+        cached_keywords = keyword_cache.get(topic)
+        if cached_keywords is not None:
+            keywords_by_topic[topic] = cached_keywords
+        else:
+            misses.setdefault(normalize_topic(topic), topic)
+    
+    missed_topics = list(misses.values())
+    batch_size = max(1, KEYWORD_BATCH_SIZE)
+    for i in range(0, len(missed_topics), batch_size):
+        chunk = missed_topics[i:i + batch_size]
+        
+        parsed = {}
+        if len(chunk) > 1:
+            try:
+                parsed = generate_keywords_for_chunk(chunk)
+                print(f"Batched keyword generation covered {len(parsed)}/{len(chunk)} topics")
+            except Exception as e:
+                print(f"Batched keyword generation failed: {str(e)}")
+        
+        for topic in chunk:
+            if topic in parsed:
+                keyword_cache.put(topic, parsed[topic])
+                keywords_by_topic[topic] = parsed[topic]
+            else:
+                # Per-topic path, including its own fallback; the cache was already checked
+                keywords_by_topic[topic] = generate_keywords_with_llm(topic, use_cache=False)
+    
+    # Spelling variants of the same topic share one result
+    for topic in topics:
+        if topic not in keywords_by_topic:
+            keywords_by_topic[topic] = keywords_by_topic[misses[normalize_topic(topic)]]
+    
+    return keywords_by_topic
+
+def generate_keywords_for_chunk(topics):
+    """Ask for keywords for several topics in one structured JSON prompt.
+    
+    Topics are numbered and the model answers with a JSON object keyed by
+    those numbers, so results map back to topics without relying on the
+    model echoing the topic text. Returns only the topics that parsed.
+    """
+    numbered_topics = "\n".join(f'{i}. "{topic}"' for i, topic in enumerate(topics, 1))
+    
+    prompt = f"""<|begin_of_text|><|start_header_id|>user<|end_header_id|>
+
+You are a news search expert. Convert each user topic below into 5-7 keywords optimized for finding relevant news articles.
+
+RULES:
+- Extract the core subject matter and related terms
+- Use words that commonly appear in news headlines
+- Include both broad and specific terms
+- Prefer simple, clear keywords over complex phrases
+- Output ONLY a JSON object mapping each topic number to its list of keywords
+
+EXAMPLE:
+
+Topics:
+1. "Keep me informed about electric vehicle developments"
+2. "space exploration"
+
+Output:
+{{"1": ["electric vehicles", "Tesla", "battery technology", "EV", "automotive industry", "charging infrastructure"], "2": ["NASA", "SpaceX", "space exploration", "Mars", "rocket launch"]}}
+
+Now generate keywords for these topics:
+{numbered_topics}
+
+Output:<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+
+"""
+    
+    max_gen_len = min(MAX_BATCH_GEN_LEN, 64 * len(topics) + 64)
+    generation = invoke_llm(prompt, max_gen_len=max_gen_len, stop_at=end_of_json_object)
+    
+    # Tolerate prose or code fences around the JSON object
+    start = generation.find('{')
+    end = generation.rfind('}')
+    if start == -1 or end <= start:
+        raise ValueError("No JSON object in batched keyword response")
+    
+    response = json.loads(generation[start:end + 1])
+    
+    parsed = {}
+    for i, topic in enumerate(topics, 1):
+        raw_keywords = response.get(str(i))
+        if isinstance(raw_keywords, str):
+            raw_keywords = raw_keywords.split(',')
+        if not isinstance(raw_keywords, list):
+            continue
+        
+        keywords = clean_keywords(raw_keywords)
+        if keywords:
+            parsed[topic] = keywords
+    
+    return parsed
+
+@metrics.timed('generate_keywords_with_llm')
+def generate_keywords_with_llm(user_topic, use_cache=True):
+    """Generate search keywords from user topic using Bedrock.
+    
+    use_cache=False skips the cache lookup for callers that already missed.
+    """
+    
+    if use_cache:
+        cached_keywords = keyword_cache.get(user_topic)
+        if cached_keywords is not None:
+            return cached_keywords
     
     prompt = f"""<|begin_of_text|><|start_header_id|>user<|end_header_id|>
 
@@ -129,27 +2018,16 @@ Keywords:<|eot_id|><|start_header_id|>assistant<|end_header_id|>
 """
 
     try:
-        request_body = {
-            "prompt": prompt,
-            "max_gen_len": MAX_TOKENS,
-            "temperature": TEMPERATURE,
-            "top_p": 0.9
-        }
-        
-        response = bedrock.invoke_model(
-            modelId=MODEL_ID,
-            body=json.dumps(request_body),
-            contentType="application/json"
-        )
-        
-        response_body = json.loads(response['body'].read())
-        keywords_text = response_body['generation'].strip()
+        keywords_text = invoke_llm(prompt, stop_at=end_of_first_line)
         
         # Clean and parse keywords
-        keywords = [kw.strip() for kw in keywords_text.split(',')]
-        keywords = [kw for kw in keywords if kw and len(kw) >= 2]
+        keywords = clean_keywords(keywords_text.split(','))
+        
+        # Only successful LLM results are cached; fallbacks retry tomorrow
+        if keywords:
+            keyword_cache.put(user_topic, keywords)
         
-        return keywords[:7]  # Limit to 7 keywords
+        return keywords
         
     except Exception as e:
         print(f"LLM keyword generation failed: {str(e)}")
@@ -157,41 +2035,94 @@ Keywords:<|eot_id|><|start_header_id|>assistant<|end_header_id|>
         words = user_topic.lower().split()
         return [word for word in words if len(word) >= 4][:5]
 
-def fetch_news_articles(keywords):
-    """Fetch articles using first 5 keywords, then rank by relevance"""
+def prefetch_articles(keyword_windows):
+    """Fetch each distinct keyword once into the shared article cache.
+    
+    Takes (keyword, since) pairs; a keyword wanted by several users is
+    fetched from the earliest of their watermarks.
+    """
+    
+    distinct_keywords = {}
+    for keyword, since in keyword_windows:
+        key = normalize_keyword(keyword)
+        if key in distinct_keywords:
+            keyword, earliest = distinct_keywords[key]
+            since = min(since, earliest)
+        distinct_keywords[key] = (keyword, since)
+    
+    print(f"Prefetching articles for {len(distinct_keywords)} distinct keywords")
+    
+    for keyword, articles, error in fetch_keywords_concurrently(list(distinct_keywords.values())):
+        if error:
+            print(f"Error prefetching keyword '{keyword}': {str(error)}")
+
+def fetch_keywords_concurrently(keyword_windows):
+    """Fetch (keyword, since) pairs through the shared pool.
+    
+    Returns (keyword, articles, error) tuples in the same order as the
+    input keywords, so callers see results exactly as a sequential loop would.
+    """
+    futures = [
+        news_fetch_pool.submit(article_cache.get_or_fetch, keyword, since)
+        for keyword, since in keyword_windows
+    ]
+    
+    results = []
+    for (keyword, _), future in zip(keyword_windows, futures):
+        try:
+            results.append((keyword, future.result(), None))
+        except Exception as e:
+            results.append((keyword, None, e))
+    return results
+
+def fetch_news_articles(keywords, since=None, exclude_urls=()):
+    """Fetch articles using first 5 keywords, then rank by relevance.
+    
+    Only articles published since the user's watermark are considered, and
+    URLs in exclude_urls (sent in the user's recent digests) are skipped.
+    """
     
     all_articles = []
-    seen_urls = set()
+    seen_urls = set(exclude_urls)
     
     try:
         # Use first 5 keywords only
-        search_keywords = keywords[:5]
-        print(f"Searching with keywords: {search_keywords}")
+        search_keywords = keywords[:SEARCH_KEYWORD_LIMIT]
+        print(f"Searching with keywords: {search_keywords} since {since or 'lookback'}")
         
-        # Fetch articles for each keyword individually
-        for keyword in search_keywords:
-            try:
-                articles = call_news_api_everything(keyword)
-                print(f"Keyword '{keyword}' returned {len(articles)} articles")
-                
-                # Add unique articles
-                for article in articles:
-                    url = article.get('url', '')
-                    if url and url not in seen_urls:
-                        seen_urls.add(url)
-                        all_articles.append(article)
-                        
-            except Exception as e:
-                print(f"Error fetching for keyword '{keyword}': {str(e)}")
+        # Fetch all keywords concurrently, then merge in keyword order
+        for keyword, articles, error in fetch_keywords_concurrently([(keyword, since) for keyword in search_keywords]):
+            if error:
+                print(f"Error fetching for keyword '{keyword}': {str(error)}")
                 continue
+            
+            print(f"Keyword '{keyword}' returned {len(articles)} articles")
+            
+            if RANKING_MODE == 'bm25':
+                # Cached articles may predate the corpus's last daily reset; known URLs are skipped
+                article_corpus.add(articles, news_lookback_floor()[:10])
+            
+            # Add unique articles
+            for article in articles:
+                url = article.get('url', '')
+                if url and url not in seen_urls:
+                    seen_urls.add(url)
+                    all_articles.append(article)
         
         print(f"Total unique articles collected: {len(all_articles)}")
         
-        # Rank articles by relevance to all keywords
-        ranked_articles = rank_articles_by_relevance(all_articles, keywords)
-        
-        # Return top 10 articles
-        top_articles = ranked_articles[:10]
+        if RANKING_MODE == 'bm25':
+            # Ranked against everything fetched today, not only this user's keywords
+            top_articles = rank_articles_bm25(keywords, top_k=TOP_ARTICLE_COUNT, since=since, exclude_urls=exclude_urls)
+        else:
+            # Wire stories republished under many URLs would otherwise take several slots
+            distinct_articles = collapse_near_duplicates(all_articles)
+            if len(distinct_articles) < len(all_articles):
+                print(f"Collapsed {len(all_articles) - len(distinct_articles)} near-duplicate articles")
+                metrics.increment('articles.near_duplicates', len(all_articles) - len(distinct_articles))
+            
+            # Rank articles by relevance to all keywords, keeping the top 10
+            top_articles = rank_articles_by_relevance(distinct_articles, keywords, top_k=TOP_ARTICLE_COUNT)
         print(f"Selected top {len(top_articles)} articles after relevance ranking")
         
         return top_articles
@@ -200,14 +2131,21 @@ def fetch_news_articles(keywords):
         print(f"Error fetching articles: {str(e)}")
         return []
 
-def call_news_api_everything(keyword):
-    """Make API call to News API /everything endpoint for a single keyword"""
+@metrics.timed('call_news_api_everything')
+def call_news_api_everything(keyword, window=None):
+    """Make API call to News API /everything endpoint for a single keyword.
     
-    url = "https://newsapi.org/v2/everything"
+    window is a (since, until) pair of News API timestamps; until is None
+    for articles up to now. Requests go through news_guard. Raises on
+    transport or HTTP errors once retries are used up, or at once while the
+    circuit is open, so callers can tell a failed fetch from a keyword with
+    no results.
+    """
     
-    # Calculate date range (last 7 days)
-    week_ago = (datetime.utcnow() - timedelta(days=7)).strftime('%Y-%m-%d')
-    today = datetime.utcnow().strftime('%Y-%m-%d')
+    url = NEWS_API_URL
+    
+    # Only the window not yet seen is requested (the full lookback by default)
+    since, until = window or (news_lookback_floor(), None)
     
     # URL encode the keyword
     encoded_keyword = urllib.parse.quote(keyword)
@@ -217,110 +2155,290 @@ def call_news_api_everything(keyword):
         'q': encoded_keyword,
         'language': 'en',
         'sortBy': 'publishedAt',  # Get most recent first
-        'from': week_ago,
-        'to': today,
-        'pageSize': 30  # Get more articles per keyword
+        'from': since.rstrip('Z'),
+        'pageSize': NEWS_PAGE_SIZE
     }
+    if until:
+        params['to'] = until.rstrip('Z')
     
-    try:
-        response = requests.get(url, params=params, timeout=15)
+    return news_guard.call(request_news_api, keyword, url, params)
+
+def request_news_api(keyword, url, params):
+    """One News API request; 429 and 5xx responses raise RetryableError"""
+    response = news_http.request('GET', url, fields=params, timeout=15)
+    metrics.increment('news_api.calls')
+    
+    if response.status != 200:
+        metrics.increment('news_api.errors')
+        message = f"News API error for '{keyword}': {response.status}"
+        if response.status == 429 or response.status >= 500:
+            raise RetryableError(message, response.headers.get('Retry-After'), throttled=response.status == 429)
+        raise Exception(message)
+    
+    data = json.loads(response.data)
+    return data.get('articles', [])
+
+def collapse_near_duplicates(articles, max_distance=NEAR_DUPLICATE_MAX_DISTANCE):
+    """Keep one representative of each group of near-duplicate articles.
+    
+    Articles whose SimHash fingerprints differ in at most max_distance bits
+    are duplicates. Fingerprints are split into max_distance + 1 bands, and
+    any two fingerprints that close must agree on at least one whole band,
+    so each article is only compared against articles sharing a band
+    instead of against every article kept so far. The representative is
+    the most informative copy; it takes the position of the first copy.
+    """
+    if max_distance < 0:
+        return list(articles)
+    
+    bands = simhash_bands(max_distance + 1)
+    buckets = [{} for _ in bands]
+    kept = []  # [article, fingerprint] in first-seen order
+    
+    for article in articles:
+        fingerprint = article_fingerprint(article)
+        if fingerprint is None:
+            kept.append([article, None])
+            continue
         
-        if response.status_code == 200:
-            data = response.json()
-            articles = data.get('articles', [])
-            return articles
-        else:
-            print(f"News API error for '{keyword}': {response.status_code}")
-            return []
-            
-    except Exception as e:
-        print(f"Request error for keyword '{keyword}': {str(e)}")
-        return []
+        keys = [(fingerprint >> shift) & mask for shift, mask in bands]
+        match = None
+        for bucket, key in zip(buckets, keys):
+            for index in bucket.get(key, ()):
+                if bin(fingerprint ^ kept[index][1]).count('1') <= max_distance:
+                    match = index
+                    break
+            if match is not None:
+                break
+        
+        if match is None:
+            for bucket, key in zip(buckets, keys):
+                bucket.setdefault(key, []).append(len(kept))
+            kept.append([article, fingerprint])
+        elif article_information(article) > article_information(kept[match][0]):
+            kept[match][0] = article
+    
+    return [article for article, _ in kept]
+
+def simhash_bands(band_count):
+    """(shift, mask) pairs splitting a 64-bit fingerprint into band_count bands"""
+    band_count = min(band_count, 64)
+    bands = []
+    start = 0
+    for i in range(band_count):
+        width = 64 // band_count + (1 if i < 64 % band_count else 0)
+        bands.append((start, (1 << width) - 1))
+        start += width
+    return bands
 
-def rank_articles_by_relevance(articles, keywords):
-    """Rank articles by how many times keywords appear in all fields"""
+def article_information(article):
+    """How much text an article carries, used to pick a duplicate group's representative"""
+    description = article.get('description') or ''
+    content = article.get('content') or ''
+    return (bool(description), len(description) + len(content))
+
+def article_fingerprint(article):
+    """64-bit SimHash of an article's title and description, or None if it has no words"""
+    key = article.get('url') or f"{article.get('title')}\n{article.get('description')}"
+    fingerprint = fingerprint_cache.get(key)
+    if fingerprint is None:
+        text = f"{article.get('title') or ''} {article.get('description') or ''}"
+        fingerprint = simhash(text)
+        fingerprint_cache.put(key, fingerprint)
+    return fingerprint if fingerprint >= 0 else None
+
+# Each byte value spread into eight 24-bit lanes, so one integer addition
+# tallies all 64 SimHash bit votes of a word at once
+SIMHASH_LANE_BITS = 24
+SIMHASH_LANES = [
+    sum(((value >> bit) & 1) << (SIMHASH_LANE_BITS * bit) for bit in range(8))
+    for value in range(256)
+]
+
+def simhash(text):
+    """64-bit SimHash over word counts; -1 if the text has no words.
     
-    def calculate_relevance_score(article, keywords):
-        """Calculate relevance score for an article"""
-        score = 0
+    Single words (not shingles) keep reworded or reordered syndicated
+    copies within a few bits of each other.
+    """
+    words = Counter(word for word in re.findall(r'\w+', text.lower()) if len(word) > 1)
+    if not words:
+        return -1
+    
+    lane_mask = (1 << SIMHASH_LANE_BITS) - 1
+    votes = 0
+    total_weight = 0
+    for word, weight in words.items():
+        hashed = hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest()
+        spread = 0
+        for i, byte in enumerate(hashed):
+            spread |= SIMHASH_LANES[byte] << (8 * SIMHASH_LANE_BITS * i)
+        votes += spread * weight
+        total_weight += weight
+    
+    # A bit is set when words voting for it outweigh those voting against
+    fingerprint = 0
+    for bit in range(64):
+        if 2 * ((votes >> (SIMHASH_LANE_BITS * bit)) & lane_mask) > total_weight:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+class KeywordMatcher:
+    """Counts whole-word keyword occurrences for many keywords in one scan.
+    
+    All keywords are compiled into a single lookahead alternation that finds
+    every position where some keyword starts. Each candidate position is then
+    checked against the keywords sharing its first character, applying the
+    same word-boundary and non-overlapping semantics as a per-keyword
+    re.findall(r'\bkeyword\b', text).
+    """
+    
+    def __init__(self, keywords):
+        # Duplicate keywords are counted once per occurrence in the list
+        self.weights = Counter(kw.lower() for kw in keywords if kw)
+        
+        self.by_first_char = {}
+        for keyword in self.weights:
+            self.by_first_char.setdefault(keyword[0], []).append(keyword)
         
-        # Get all text fields from the article
-        title = article.get('title', '').lower()
-        description = article.get('description', '').lower()
-        content = article.get('content', '').lower()
+        alternation = '|'.join(re.escape(kw) for kw in sorted(self.weights, key=len, reverse=True))
+        self.pattern = re.compile(f'(?=(?:{alternation}))') if alternation else None
+    
+    def count(self, text):
+        """Return the weighted number of keyword matches in lowercase text"""
+        if self.pattern is None or not text:
+            return 0
         
-        # Combine all text for searching
-        full_text = f"{title} {description} {content}"
+        total = 0
+        next_allowed = {}
+        length = len(text)
         
-        # Count keyword occurrences
-        for keyword in keywords:
-            keyword_lower = keyword.lower()
-            
-            # Count occurrences in full text
-            keyword_count = len(re.findall(r'\b' + re.escape(keyword_lower) + r'\b', full_text))
+        for match in self.pattern.finditer(text):
+            start = match.start()
             
-            # Weight different fields differently
-            title_count = len(re.findall(r'\b' + re.escape(keyword_lower) + r'\b', title))
-            description_count = len(re.findall(r'\b' + re.escape(keyword_lower) + r'\b', description))
-            content_count = len(re.findall(r'\b' + re.escape(keyword_lower) + r'\b', content))
+            # \b before the keyword: word-ness changes between start-1 and start
+            before_is_word = start > 0 and _is_word_char(text[start - 1])
+            if before_is_word == _is_word_char(text[start]):
+                continue
             
-            # Title matches are worth more
-            score += title_count * 3
-            score += description_count * 2  
-            score += content_count * 1
+            for keyword in self.by_first_char[text[start]]:
+                if start < next_allowed.get(keyword, 0) or not text.startswith(keyword, start):
+                    continue
+                
+                # \b after the keyword: word-ness changes between end-1 and end
+                end = start + len(keyword)
+                after_is_word = end < length and _is_word_char(text[end])
+                if after_is_word == _is_word_char(text[end - 1]):
+                    continue
+                
+                total += self.weights[keyword]
+                next_allowed[keyword] = end
+        
+        return total
+
+def _is_word_char(char):
+    """Match the regex module's Unicode \\w definition"""
+    return char.isalnum() or char == '_'
+
+@metrics.timed('rank_articles_by_relevance')
+def rank_articles_by_relevance(articles, keywords, top_k=None):
+    """Rank articles by how many times keywords appear in all fields.
+    
+    Title matches are worth 3, description 2 and content 1. When top_k is
+    given only the best top_k articles are selected, using a heap instead of
+    sorting the whole candidate list.
+    """
+    
+    matcher = KeywordMatcher(keywords)
+    
+    def calculate_relevance_score(article):
+        """Calculate relevance score for an article"""
+        # NewsAPI returns null for missing fields, so treat None as empty
+        title = (article.get('title') or '').lower()
+        description = (article.get('description') or '').lower()
+        content = (article.get('content') or '').lower()
         
-        return score
+        # Title matches are worth more
+        return (
+            matcher.count(title) * 3
+            + matcher.count(description) * 2
+            + matcher.count(content) * 1
+        )
     
     # Calculate relevance scores for all articles
-    articles_with_scores = []
+    articles_with_scores = [
+        {'article': article, 'relevance_score': calculate_relevance_score(article)}
+        for article in articles
+    ]
     
-    for article in articles:
-        score = calculate_relevance_score(article, keywords)
-        articles_with_scores.append({
-            'article': article,
-            'relevance_score': score
-        })
+    # Order by relevance score (highest first), then by publication date
+    def sort_key(item):
+        return (item['relevance_score'], item['article'].get('publishedAt') or '')
     
-    # Sort by relevance score (highest first), then by publication date
-    articles_with_scores.sort(
-        key=lambda x: (x['relevance_score'], x['article'].get('publishedAt', '')), 
-        reverse=True
-    )
+    if top_k is None:
+        articles_with_scores.sort(key=sort_key, reverse=True)
+    else:
+        # Equivalent to sorted(..., reverse=True)[:top_k], ties included
+        articles_with_scores = heapq.nlargest(top_k, articles_with_scores, key=sort_key)
     
     # Log top articles for debugging
     print("Top 5 articles by relevance:")
     for i, item in enumerate(articles_with_scores[:5]):
-        title = item['article'].get('title', 'No title')[:50]
+        title = (item['article'].get('title') or 'No title')[:50]
         score = item['relevance_score']
         print(f"  {i+1}. Score: {score} - {title}...")
     
     # Return just the articles (without scores)
     return [item['article'] for item in articles_with_scores]
 
+@metrics.timed('rank_articles_bm25')
+def rank_articles_bm25(keywords, top_k=TOP_ARTICLE_COUNT, since=None, exclude_urls=()):
+    """Rank today's article corpus for the keywords with BM25F.
+    
+    Articles published before since or listed in exclude_urls are skipped.
+    Extra candidates are taken so near-duplicates can be collapsed without
+    leaving empty slots. Each story keeps the rank of its best-scoring copy,
+    but the copy kept is the one with the most text, so the logged score is
+    that copy's own.
+    """
+    since = since or news_lookback_floor()
+    exclude_urls = set(exclude_urls)
+    
+    def accept(article):
+        return (article.get('publishedAt') or '') >= since and article.get('url') not in exclude_urls
+    
+    candidates = article_corpus.search(keywords, top_k * BM25_CANDIDATE_FACTOR, accept)
+    scores = {id(article): score for article, score in candidates}
+    
+    distinct_articles = collapse_near_duplicates([article for article, _ in candidates])
+    if len(distinct_articles) < len(candidates):
+        metrics.increment('articles.near_duplicates', len(candidates) - len(distinct_articles))
+    # Each story keeps the position of its best-scoring copy (collapse keeps the fullest copy)
+    top_articles = distinct_articles[:top_k]
+    
+    print("Top 5 articles by BM25F:")
+    for i, article in enumerate(top_articles[:5]):
+        title = (article.get('title') or 'No title')[:50]
+        print(f"  {i+1}. Score: {scores.get(id(article), 0.0):.2f} - {title}...")
+    
+    return top_articles
+
+@metrics.timed('generate_digest_content')
 def generate_digest_content(topic, articles):
     """Generate final HTML email content using Bedrock"""
     
     if not articles:
         return generate_no_news_digest(topic)
     
-    # Prepare articles for LLM
-    articles_text = ""
-    for i, article in enumerate(articles, 1):
-        title = article.get('title', 'No title')
-        description = article.get('description', 'No description')
-        content = article.get('content', '')[:200]  # First 200 chars of content
-        source = article.get('source', {}).get('name', 'Unknown')
-        published = article.get('publishedAt', 'Unknown date')
-        
-        articles_text += f"""
-Article {i}:
-Title: {title}
-Description: {description}
-Content Preview: {content}
-Source: {source}
-Published: {published}
----
-"""
+    cached_digest = digest_cache.get(topic, articles)
+    if cached_digest is not None:
+        return cached_digest
+    
+    # Prepare articles for LLM, trimmed to the prompt budget by rank
+    articles_text, kept_count = build_digest_articles_text(articles)
+    if kept_count < len(articles):
+        print(f"Digest prompt budget kept {kept_count}/{len(articles)} articles")
+        metrics.increment('digest_prompt.articles_dropped', len(articles) - kept_count)
     
     prompt = f"""<|begin_of_text|><|start_header_id|>user<|end_header_id|>
 
@@ -370,26 +2488,83 @@ Example structure:
 """
 
     try:
-        request_body = {
-            "prompt": prompt,
-            "max_gen_len": MAX_TOKENS,
-            "temperature": TEMPERATURE,
-            "top_p": 0.9
-        }
-        
-        response = bedrock.invoke_model(
-            modelId=MODEL_ID,
-            body=json.dumps(request_body),
-            contentType="application/json"
-        )
+        # Output is sized to the stories it has to cover
+        max_gen_len = min(MAX_TOKENS, DIGEST_BASE_GEN_TOKENS + DIGEST_GEN_TOKENS_PER_ARTICLE * kept_count)
+        digest_content = invoke_llm(prompt, max_gen_len=max_gen_len, stop_at=end_of_html)
         
-        response_body = json.loads(response['body'].read())
-        return response_body['generation'].strip()
+        # Fallback digests are not cached so later users can retry the LLM
+        digest_cache.put(topic, articles, digest_content)
+        return digest_content
         
     except Exception as e:
         print(f"Error generating digest: {str(e)}")
         return generate_fallback_digest(topic, articles)
 
+def build_digest_articles_text(articles, token_budget=DIGEST_ARTICLE_TOKEN_BUDGET):
+    """Render ranked articles for the digest prompt within a token budget.
+    
+    Higher-ranked articles keep more of their description and content
+    (DIGEST_FIELD_LIMITS). Articles are added in rank order until the next
+    one would exceed the budget; the top article is always kept. Returns
+    (articles_text, kept_count).
+    """
+    blocks = []
+    used_tokens = 0
+    
+    for rank, article in enumerate(articles):
+        description_limit, content_limit = (
+            DIGEST_FIELD_LIMITS[rank] if rank < len(DIGEST_FIELD_LIMITS) else (0, 0)
+        )
+        title = compact_article_text(article.get('title'), 200) or 'No title'
+        description = compact_article_text(article.get('description'), description_limit)
+        content = compact_article_text(article.get('content'), content_limit)
+        
+        # NewsAPI content usually opens by repeating the description
+        if content and description and content[:60].rstrip('…') in description:
+            content = ''
+        
+        lines = [f"Article {rank + 1}:", f"Title: {title}"]
+        if description:
+            lines.append(f"Description: {description}")
+        if content:
+            lines.append(f"Content Preview: {content}")
+        lines.append(f"Source: {(article.get('source') or {}).get('name') or 'Unknown'}")
+        lines.append(f"Published: {(article.get('publishedAt') or 'Unknown date')[:10]}")
+        block = "\n".join(lines) + "\n---\n"
+        
+        block_tokens = estimate_tokens(block)
+        if blocks and used_tokens + block_tokens > token_budget:
+            break
+        blocks.append(block)
+        used_tokens += block_tokens
+    
+    return "\n" + "\n".join(blocks), len(blocks)
+
+NEWSAPI_TRUNCATION_MARKER = re.compile(r'\s*(?:…|\.\.\.)?\s*\[\+\d+ chars\]\s*$')
+HTML_TAG = re.compile(r'<[^>]+>')
+BOILERPLATE = re.compile(
+    r'(?i)\b(?:continue reading|read more|read the full story|click here|'
+    r'sign up for [^.]*newsletter[^.]*|subscribe (?:now|today|to [^.]*))[.…:]*'
+)
+
+def compact_article_text(text, max_chars):
+    """Strip NewsAPI truncation markers, markup and boilerplate, then cut at a word boundary"""
+    if not text or max_chars <= 0:
+        return ''
+    
+    text = HTML_TAG.sub(' ', text)
+    text = NEWSAPI_TRUNCATION_MARKER.sub('', text)
+    text = BOILERPLATE.sub('', text)
+    text = ' '.join(text.split())
+    
+    if len(text) > max_chars:
+        text = text[:max_chars].rsplit(' ', 1)[0].rstrip(',;:') + '…'
+    return text
+
+def estimate_tokens(text):
+    """Rough Llama token count for English text (~4 characters per token)"""
+    return (len(text) + 3) // 4
+
 def generate_no_news_digest(topic):
     """Generate pickle-themed message when no articles found"""
     
@@ -438,12 +2613,11 @@ HTML: <html><body style="font-family: Arial, sans-serif; max-width: 600px; margi
 <p>Stay pickled! 🥒</p>
 </body></html>"""
 
+@metrics.timed('store_digest')
 def store_digest(email, topic, digest_content, article_count):
-    """Store ready-to-send digest in DynamoDB"""
+    """Queue ready-to-send digest for a batched write to DynamoDB"""
     
     try:
-        table = dynamodb.Table(DIGESTS_TABLE)
-        
         today = datetime.utcnow().strftime('%Y-%m-%d')
         
         # Parse subject and HTML from digest content
@@ -468,10 +2642,11 @@ def store_digest(email, topic, digest_content, article_count):
             'ttl': int((datetime.utcnow() + timedelta(days=3)).timestamp())
         }
 
-        print(html_content)
+        if LOG_DIGEST_HTML:
+            print(html_content)
         
-        table.put_item(Item=item)
-        print(f"Stored digest for {email}")
+        digest_sink.add(item)
+        print(f"Queued digest for {email}")
         
     except Exception as e:
         print(f"Error storing digest: {str(e)}")